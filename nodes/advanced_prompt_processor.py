@@ -18,8 +18,20 @@
 import re
 import json
 import os
+import math
+import hashlib
+import sys
+import mmap
+import struct
+import threading
+import time
+import weakref
 import requests
-from typing import Dict, List, Any, Tuple
+from array import array
+from collections.abc import ItemsView, Mapping
+from itertools import compress
+from types import MappingProxyType
+from typing import Dict, List, Any, Tuple, Iterable, Iterator
 from requests.exceptions import RequestException
 from urllib.parse import urlparse
 
@@ -71,6 +83,817 @@ def get_system_proxy(manual_http_proxy="", manual_https_proxy=""):
     return None
 
 
+class TagKnowledgeBase(dict):
+    """按类别划分的标签集合（与原先返回的 dict 格式一致），附带别名索引和使用次数
+    
+    对象在多个线程间共享，创建后只读：类别转换为 frozenset，别名和使用次数为只读映射。
+    从快照加载时（提供 snapshot）别名和使用次数直接使用快照上的只读视图，不在加载时解码。
+    """
+    
+    def __init__(self, categories=(), aliases: Dict[str, str] = None, tag_counts: Dict[str, int] = None,
+                 snapshot: "TagKnowledgeSnapshot" = None):
+        super().__init__((category, tags if isinstance(tags, frozenset) else frozenset(tags))
+                         for category, tags in dict(categories).items())
+        if snapshot is None:
+            aliases = MappingProxyType(dict(aliases or {}))
+            tag_counts = MappingProxyType(dict(tag_counts or {}))
+        # 别名 → 标准标签（来自 danbooru_tags.csv 的 alias 列）
+        self.aliases = aliases
+        # 标签 → 使用次数（来自 danbooru_tags.csv 的 count 列）
+        self.tag_counts = tag_counts
+        # 支撑只读视图的快照（知识库退役后关闭）
+        self.snapshot = snapshot
+    
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("TagKnowledgeBase 是只读的共享对象")
+    
+    __setitem__ = __delitem__ = _readonly
+    update = setdefault = pop = popitem = clear = _readonly
+
+
+class TagFuzzyIndex:
+    """基于对称删除（SymSpell）的标签纠错索引
+    
+    对每个标签取前 PREFIX_LENGTH 个字符，预先生成编辑距离不超过 MAX_DISTANCE 的所有删除变体，
+    查询时只需生成查询词的删除变体即可取得候选，再用位并行（Myers）算法校验真实编辑距离。
+    距离相同的候选优先选择 danbooru_tags.csv 中使用次数(count)更高的标签。
+    """
+    
+    PREFIX_LENGTH = 7
+    MAX_DISTANCE = 2
+    # 超过该标签数时不构建纠错索引（内存占用约为标签数的数百倍字节）
+    MAX_TERMS = 500000
+    # 过短的标签不做纠错，避免把合法的新标签改成其他短标签
+    MIN_WORD_LENGTH = 5
+    # 该长度以下的标签最多纠正一个字符
+    SINGLE_EDIT_MAX_LENGTH = 8
+    
+    def __init__(self, terms: List[str], counts: List[int], postings: Dict[str, Any]):
+        self._terms = terms
+        self._counts = counts
+        # 删除变体 → 标签编号（单个编号为 int，多个为 list）
+        self._postings = postings
+    
+    @classmethod
+    def build(cls, terms: List[str], counts: List[int]) -> "TagFuzzyIndex":
+        """在内存中构建索引"""
+        postings = {}
+        for term_id, term in enumerate(terms):
+            for variant in cls.delete_variants(term[:cls.PREFIX_LENGTH], cls.MAX_DISTANCE):
+                existing = postings.get(variant)
+                if existing is None:
+                    postings[variant] = term_id
+                elif type(existing) is int:
+                    postings[variant] = [existing, term_id]
+                else:
+                    existing.append(term_id)
+        return cls(terms, counts, postings)
+    
+    def with_changes(self, added_terms: Iterable[str], removed_terms: Iterable[str],
+                     tag_counts: Dict[str, int]) -> "TagFuzzyIndex":
+        """返回增删部分标签后的新索引（未变化的倒排列表与原索引共享）"""
+        terms = list(self._terms)
+        counts = list(self._counts)
+        postings = dict(self._postings)
+        positions = {term: term_id for term_id, term in enumerate(terms) if term}
+        
+        def variants_of(term):
+            return self.delete_variants(term[:self.PREFIX_LENGTH], self.MAX_DISTANCE)
+        
+        for term in removed_terms:
+            term_id = positions.pop(term, None)
+            if term_id is None:
+                continue
+            # 保留空位，其余标签的编号不变
+            terms[term_id] = ""
+            for variant in variants_of(term):
+                existing = postings.get(variant)
+                if existing == term_id:
+                    del postings[variant]
+                elif type(existing) is list and term_id in existing:
+                    postings[variant] = [other for other in existing if other != term_id]
+        
+        for term in added_terms:
+            if term in positions:
+                continue
+            term_id = positions[term] = len(terms)
+            terms.append(term)
+            counts.append(tag_counts.get(term, 0))
+            for variant in variants_of(term):
+                existing = postings.get(variant)
+                if existing is None:
+                    postings[variant] = term_id
+                elif type(existing) is int:
+                    postings[variant] = [existing, term_id]
+                else:
+                    postings[variant] = existing + [term_id]
+        
+        return TagFuzzyIndex(terms, counts, postings)
+    
+    @staticmethod
+    def delete_variants(word: str, max_distance: int) -> set:
+        """生成删除不超过 max_distance 个字符的所有变体（包含原词）"""
+        variants = {word}
+        frontier = {word}
+        for _ in range(max_distance):
+            next_frontier = set()
+            for variant in frontier:
+                for position in range(len(variant)):
+                    next_frontier.add(variant[:position] + variant[position + 1:])
+            variants.update(next_frontier)
+            frontier = next_frontier
+        return variants
+    
+    def max_distance_for(self, word: str) -> int:
+        """按标签长度决定允许的最大编辑距离"""
+        if len(word) < self.MIN_WORD_LENGTH:
+            return 0
+        if len(word) <= self.SINGLE_EDIT_MAX_LENGTH:
+            return 1
+        return self.MAX_DISTANCE
+    
+    def suggest(self, word: str, max_distance: int = None) -> Tuple[str, int]:
+        """返回最接近的已知标签及编辑距离，没有合适候选时返回 None"""
+        if max_distance is None:
+            max_distance = self.max_distance_for(word)
+        max_distance = min(max_distance, self.MAX_DISTANCE)
+        if max_distance <= 0:
+            return None
+        
+        candidates = set()
+        for variant in self.delete_variants(word[:self.PREFIX_LENGTH], max_distance):
+            term_ids = self._postings.get(variant)
+            if term_ids is None:
+                continue
+            if type(term_ids) is int:
+                candidates.add(term_ids)
+            else:
+                candidates.update(term_ids)
+        
+        if not candidates:
+            return None
+        
+        length = len(word)
+        pattern_masks = {}
+        for position, char in enumerate(word):
+            pattern_masks[char] = pattern_masks.get(char, 0) | (1 << position)
+        
+        best = None
+        for term_id in candidates:
+            term = self._terms[term_id]
+            if abs(len(term) - length) > max_distance or term == word:
+                continue
+            distance = self._bit_parallel_distance(pattern_masks, length, term)
+            if distance > max_distance:
+                continue
+            rank = (distance, -self._counts[term_id], term)
+            if best is None or rank < best:
+                best = rank
+        
+        return (best[2], best[0]) if best else None
+    
+    @staticmethod
+    def _bit_parallel_distance(pattern_masks: Dict[str, int], length: int, text: str) -> int:
+        """Myers 位并行算法计算 Levenshtein 距离（模式的字符位掩码已预先计算）"""
+        mask = (1 << length) - 1
+        high_bit = 1 << (length - 1)
+        positive_vertical = mask
+        negative_vertical = 0
+        score = length
+        
+        for char in text:
+            equal = pattern_masks.get(char, 0)
+            vertical = equal | negative_vertical
+            horizontal = (((equal & positive_vertical) + positive_vertical) ^ positive_vertical) | equal
+            positive_horizontal = negative_vertical | (~(horizontal | positive_vertical) & mask)
+            negative_horizontal = positive_vertical & horizontal
+            
+            if positive_horizontal & high_bit:
+                score += 1
+            elif negative_horizontal & high_bit:
+                score -= 1
+            
+            positive_horizontal = ((positive_horizontal << 1) | 1) & mask
+            negative_horizontal = (negative_horizontal << 1) & mask
+            positive_vertical = negative_horizontal | (~(vertical | positive_horizontal) & mask)
+            negative_vertical = positive_horizontal & vertical
+        
+        return score
+
+
+class TagBloomFilter:
+    """知识库标签的布隆过滤器
+    
+    判定为不存在的标签一定不在知识库中，可跳过精确查找；判定为存在时仍需精确查找确认。
+    使用 blake2b 摘要拆成两个64位哈希做双重哈希，结果与进程和平台无关。
+    """
+    
+    FALSE_POSITIVE_RATE = 0.01
+    
+    def __init__(self, bits, bit_count: int, hash_count: int):
+        self._bits = bits
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+    
+    @classmethod
+    def build(cls, tags: Iterable[str], false_positive_rate: float = None, count: int = None) -> "TagBloomFilter":
+        """按标签数量和目标误判率选择位数与哈希函数个数（tags 为迭代器时需给出 count）"""
+        rate = false_positive_rate or cls.FALSE_POSITIVE_RATE
+        count = max(len(tags) if count is None else count, 1)
+        bit_count = max(64, int(math.ceil(-count * math.log(rate) / (math.log(2) ** 2))))
+        hash_count = max(1, round(bit_count / count * math.log(2)))
+        bloom = cls(bytearray((bit_count + 7) // 8), bit_count, hash_count)
+        for tag in tags:
+            bloom.add(tag)
+        return bloom
+    
+    @staticmethod
+    def _hash_pair(tag: str) -> Tuple[int, int]:
+        digest = hashlib.blake2b(tag.encode('utf-8'), digest_size=16).digest()
+        return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+    
+    def add(self, tag: str):
+        first, second = self._hash_pair(tag)
+        for index in range(self.hash_count):
+            position = (first + index * second) % self.bit_count
+            self._bits[position >> 3] |= 1 << (position & 7)
+    
+    def __contains__(self, tag: str) -> bool:
+        first, second = self._hash_pair(tag)
+        bits, bit_count = self._bits, self.bit_count
+        for index in range(self.hash_count):
+            position = (first + index * second) % bit_count
+            if not bits[position >> 3] >> (position & 7) & 1:
+                return False
+        return True
+
+
+class TagKnowledgeSnapshot:
+    """Tag knowledge 文件夹的二进制快照（磁盘缓存）
+    
+    文件布局：MAGIC + 头部长度(uint32) + JSON头部 + 按8字节对齐的数据段。
+    - tags_blob: 按码点排序（等价于UTF-8字节序）的标签，以换行拼接
+    - tags_offsets: uint32 偏移数组（标签数+1 项），可在 mmap 上直接二分查找
+    - tags_categories: 每个标签一个 uint8 位掩码，第 i 位对应头部 categories[i]
+      （掩码为0表示仅作为别名目标出现的标准标签）
+    - alias_blob / alias_offsets: 排序后的别名字符串表，格式同上
+    - alias_targets: 每个别名对应的标准标签在 tags 字符串表中的下标（uint32）
+    - tags_counts: 每个标签在 danbooru_tags.csv 中的使用次数（uint32）
+    
+    纠错索引和布隆过滤器不写入快照，在首次使用时另行构建，不占用加载时间。
+    头部记录各源文件的大小和修改时间，任何CSV变化都会使快照失效并重建。
+    内存模式只把类别解码为集合，别名和使用次数保持为映射上的视图，快照随知识库保持打开。
+    """
+    
+    MAGIC = b"APPTKB01"
+    FORMAT_VERSION = 6
+    FILENAME = ".knowledge_snapshot.bin"
+    ALIGNMENT = 8
+    
+    def __init__(self, header: Dict[str, Any], buffer, mapped=None):
+        self.header = header
+        self._buffer = buffer
+        self._mmap = mapped
+        # 已交出的数据段视图，关闭映射前需要全部释放
+        self._views = []
+    
+    @property
+    def mapped(self) -> mmap.mmap:
+        """底层 mmap 对象（切片直接返回 bytes，供字符串表二分查找使用）"""
+        return self._mmap
+    
+    @classmethod
+    def open(cls, path: str, fingerprint: List) -> "TagKnowledgeSnapshot":
+        """打开快照文件，文件不存在、格式不符或指纹不匹配时返回 None"""
+        if not os.path.exists(path):
+            return None
+        
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        
+        try:
+            buffer = memoryview(mapped)
+            prefix_size = len(cls.MAGIC) + 4
+            if len(buffer) < prefix_size or bytes(buffer[:len(cls.MAGIC)]) != cls.MAGIC:
+                raise ValueError("快照文件头无效")
+            
+            header_length = struct.unpack_from("<I", buffer, len(cls.MAGIC))[0]
+            header = json.loads(bytes(buffer[prefix_size:prefix_size + header_length]).decode('utf-8'))
+            
+            if (header.get("format_version") != cls.FORMAT_VERSION
+                    or header.get("byteorder") != sys.byteorder
+                    or header.get("fingerprint") != fingerprint):
+                raise ValueError("快照已过期")
+            
+            for offset, length, _ in header["sections"].values():
+                if offset + length > len(buffer):
+                    raise ValueError("快照文件不完整")
+            
+            return cls(header, buffer, mapped)
+            
+        except Exception:
+            buffer = None
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+            return None
+    
+    @classmethod
+    def write(cls, path: str, fingerprint: List, knowledge_base: Dict[str, set], categories) -> bool:
+        """将知识库写入快照文件（先写临时文件再原子替换），失败时返回 False"""
+        categories = list(categories)
+        aliases = getattr(knowledge_base, 'aliases', None) or {}
+        
+        masks = dict.fromkeys(aliases.values(), 0)
+        for bit, category in enumerate(categories):
+            for tag in knowledge_base.get(category, ()):
+                masks[tag] = masks.get(tag, 0) | (1 << bit)
+        
+        # 码点顺序与UTF-8字节序一致，排序结果可直接按字节二分查找
+        tags = sorted(masks)
+        alias_keys = sorted(aliases)
+        if any('\n' in text for text in tags + alias_keys) or array('I').itemsize != 4:
+            return False
+        
+        tag_positions = {tag: position for position, tag in enumerate(tags)}
+        tags_blob, tags_offsets = cls._build_string_table(tags)
+        alias_blob, alias_offsets = cls._build_string_table(alias_keys)
+        alias_targets = array('I', [tag_positions[aliases[alias]] for alias in alias_keys])
+        tag_counts = getattr(knowledge_base, 'tag_counts', None) or {}
+        counts = array('I', [min(tag_counts.get(tag, 0), 0xFFFFFFFF) for tag in tags])
+        
+        sections = [
+            ("tags_blob", tags_blob, "B"),
+            ("tags_offsets", tags_offsets.tobytes(), "I"),
+            ("tags_categories", bytes(masks[tag] for tag in tags), "B"),
+            ("tags_counts", counts.tobytes(), "I"),
+            ("alias_blob", alias_blob, "B"),
+            ("alias_offsets", alias_offsets.tobytes(), "I"),
+            ("alias_targets", alias_targets.tobytes(), "I"),
+        ]
+        
+        return cls._write_sections(path, {
+            "format_version": cls.FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "fingerprint": fingerprint,
+            "categories": categories,
+            "tag_count": sum(1 for mask in masks.values() if mask),
+            "alias_count": len(alias_keys),
+        }, sections)
+    
+    @staticmethod
+    def _build_string_table(strings: List[str]):
+        """将已排序的字符串列表编码为换行拼接的UTF-8数据和 uint32 偏移数组"""
+        blob = "".join(text + "\n" for text in strings).encode('utf-8')
+        offsets = array('I', [0])
+        position = 0
+        for text in strings:
+            position += len(text.encode('utf-8')) + 1
+            offsets.append(position)
+        return blob, offsets
+    
+    @classmethod
+    def _write_sections(cls, path: str, header: Dict[str, Any], sections: List) -> bool:
+        """计算各数据段偏移并写出文件"""
+        # 头部长度会影响数据段偏移，先用占位偏移估算头部大小
+        header["sections"] = {name: [0, len(data), typecode] for name, data, typecode in sections}
+        prefix_size = len(cls.MAGIC) + 4
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        # 预留偏移数字变长的空间
+        data_start = cls._align(prefix_size + len(header_bytes) + 32 * len(sections))
+        
+        position = data_start
+        for name, data, typecode in sections:
+            header["sections"][name][0] = position
+            position = cls._align(position + len(data))
+        
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        if prefix_size + len(header_bytes) > data_start:
+            return False
+        
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(cls.MAGIC)
+                f.write(struct.pack("<I", len(header_bytes)))
+                f.write(header_bytes)
+                for name, data, _ in sections:
+                    f.write(b"\0" * (header["sections"][name][0] - f.tell()))
+                    f.write(data)
+            os.replace(temp_path, path)
+            return True
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+    
+    @classmethod
+    def _align(cls, position: int) -> int:
+        return (position + cls.ALIGNMENT - 1) // cls.ALIGNMENT * cls.ALIGNMENT
+    
+    def section(self, name: str) -> memoryview:
+        """获取数据段的只读视图（uint32 段会转换为对应类型）"""
+        offset, length, typecode = self.header["sections"][name]
+        view = self._buffer[offset:offset + length]
+        self._views.append(view)
+        if typecode != "B":
+            view = view.cast(typecode)
+            self._views.append(view)
+        return view
+    
+    def to_knowledge_base(self) -> TagKnowledgeBase:
+        """还原为按类别划分的标签集合；别名和使用次数为快照上的只读视图（首次查找时才读取）"""
+        tags = self.read_strings("tags_blob")
+        masks = bytes(self.section("tags_categories"))
+        
+        categories = {}
+        for bit, category in enumerate(self.header["categories"]):
+            # 用 translate 把位掩码转换成 0/1 选择器，避免逐个标签的 Python 循环
+            selector_table = bytes((value >> bit) & 1 for value in range(256))
+            categories[category] = frozenset(compress(tags, masks.translate(selector_table)))
+        
+        tag_table = MappedStringTable(self, "tags_blob", "tags_offsets")
+        alias_keys = MappedStringTable(self, "alias_blob", "alias_offsets")
+        aliases = MappedTableMapping(alias_keys, self.section("alias_targets"), tag_table.__getitem__)
+        tag_counts = MappedTableMapping(tag_table, self.section("tags_counts"))
+        
+        return TagKnowledgeBase(categories, aliases, tag_counts, snapshot=self)
+    
+    def read_array(self, name: str) -> List[int]:
+        """一次性读取整数数据段"""
+        view = self.section(name)
+        try:
+            return view.tolist()
+        finally:
+            view.release()
+    
+    def read_strings(self, name: str) -> List[str]:
+        """一次性解码整个字符串表"""
+        blob = self.section(name)
+        try:
+            return str(blob, 'utf-8').split('\n')[:-1]
+        finally:
+            blob.release()
+    
+    def close(self):
+        """释放全部数据段视图和 mmap 映射（视图被再次导出时保留映射，由垃圾回收释放）"""
+        try:
+            while self._views:
+                self._views.pop().release()
+            if self._buffer is not None:
+                self._buffer.release()
+                self._buffer = None
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+        except BufferError:
+            pass
+
+
+class MappedStringTable:
+    """快照中已排序字符串表的只读视图
+    
+    直接在 mmap 上按下标解码或按UTF-8字节二分查找，不创建整表的 Python 字符串。
+    """
+    
+    def __init__(self, snapshot: "TagKnowledgeSnapshot", blob_name: str, offsets_name: str):
+        self._data = snapshot.mapped
+        self._base = snapshot.header["sections"][blob_name][0]
+        self._offsets = snapshot.section(offsets_name)
+        self._count = len(self._offsets) - 1
+    
+    def __len__(self) -> int:
+        return self._count
+    
+    def __getitem__(self, index: int) -> str:
+        offsets = self._offsets
+        # 每个字符串后跟一个换行符
+        return self._data[self._base + offsets[index]:self._base + offsets[index + 1] - 1].decode('utf-8')
+    
+    def __iter__(self) -> Iterator[str]:
+        for index in range(self._count):
+            yield self[index]
+    
+    def find(self, text: str) -> int:
+        """二分查找字符串的下标，不存在时返回 -1"""
+        key = text.encode('utf-8')
+        data, base, offsets = self._data, self._base, self._offsets
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            value = data[base + offsets[middle]:base + offsets[middle + 1] - 1]
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return middle
+        return -1
+
+
+class MappedTableMapping(Mapping):
+    """以快照字符串表为键、整数数据段为值的只读映射（别名表、使用次数）"""
+    
+    def __init__(self, keys: MappedStringTable, values, convert=None):
+        self._keys = keys
+        self._values = values
+        self._convert = convert
+    
+    def __getitem__(self, key: str):
+        position = self._keys.find(key) if isinstance(key, str) else -1
+        if position < 0:
+            raise KeyError(key)
+        value = self._values[position]
+        return self._convert(value) if self._convert else value
+    
+    def __len__(self) -> int:
+        return len(self._keys)
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys)
+    
+    def items(self) -> ItemsView:
+        return MappedItemsView(self)
+
+
+class MappedItemsView(ItemsView):
+    """按表顺序遍历快照映射的 (键, 值)，不对每个键重新二分查找"""
+    
+    def __iter__(self):
+        mapping = self._mapping
+        convert = mapping._convert
+        for key, value in zip(mapping._keys, mapping._values):
+            yield key, convert(value) if convert else value
+
+
+class MappedTagSet:
+    """快照中某一类别的标签集合视图，支持 in / len / 迭代"""
+    
+    def __init__(self, tags: MappedStringTable, masks: memoryview, bit: int):
+        self._tags = tags
+        self._masks = masks
+        self._bit = bit
+        self._length = None
+    
+    def __contains__(self, tag) -> bool:
+        position = self._tags.find(tag) if isinstance(tag, str) else -1
+        return position >= 0 and bool(self._masks[position] >> self._bit & 1)
+    
+    def __len__(self) -> int:
+        if self._length is None:
+            selector_table = bytes((value >> self._bit) & 1 for value in range(256))
+            self._length = bytes(self._masks).translate(selector_table).count(1)
+        return self._length
+    
+    def __iter__(self) -> Iterator[str]:
+        bit, masks = self._bit, self._masks
+        for position in range(len(self._tags)):
+            if masks[position] >> bit & 1:
+                yield self._tags[position]
+
+
+class MappedTagKnowledgeBase(TagKnowledgeBase):
+    """直接映射快照文件的知识库（mmap 存储模式）
+    
+    类别集合、别名和使用次数都是快照上的只读视图，查找时在 mmap 上二分查找。
+    多个进程映射同一快照文件时共享操作系统的页缓存，进程内几乎不占用标签数据内存。
+    """
+    
+    def __init__(self, snapshot: "TagKnowledgeSnapshot"):
+        self.tags = MappedStringTable(snapshot, "tags_blob", "tags_offsets")
+        self.masks = snapshot.section("tags_categories")
+        dict.__init__(self, ((category, MappedTagSet(self.tags, self.masks, bit))
+                             for bit, category in enumerate(snapshot.header["categories"])))
+        alias_keys = MappedStringTable(snapshot, "alias_blob", "alias_offsets")
+        self.aliases = MappedTableMapping(alias_keys, snapshot.section("alias_targets"), self.tags.__getitem__)
+        self.tag_counts = MappedTableMapping(self.tags, snapshot.section("tags_counts"))
+        self.snapshot = snapshot
+
+
+class MappedTagIndex(Mapping):
+    """mmap 模式下的 tag → 类别 编译索引
+    
+    内置数据库的标签放在一个小字典中；其余标签只属于外部知识库，
+    其类别就是位掩码中按 KNOWLEDGE_PRIORITY_ORDER 排在最前的类别，预先算成 256 项的查找表。
+    未知标签先经过布隆过滤器，绝大多数无需在 mmap 上二分查找即可判定为未命中。
+    """
+    
+    def __init__(self, knowledge_base: MappedTagKnowledgeBase, builtin_index: Dict[str, str],
+                 mask_categories: List[str], bloom: TagBloomFilter = None):
+        # 保持知识库的引用：索引仍在使用时快照映射不会被关闭
+        self._knowledge_base = knowledge_base
+        self._tags = knowledge_base.tags
+        self._masks = knowledge_base.masks
+        self._builtin_index = builtin_index
+        self._mask_categories = mask_categories
+        self._bloom = bloom
+    
+    def build_bloom_filter(self, tag_count: int):
+        """为知识库标签（掩码非0）构建布隆过滤器，完成后才启用"""
+        masks = self._masks
+        self._bloom = TagBloomFilter.build(
+            (tag for position, tag in enumerate(self._tags) if masks[position]), count=tag_count
+        )
+    
+    def get(self, tag: str, default=None):
+        category = self.lookup(tag)
+        return default if category is None else category
+    
+    def lookup(self, tag: str, stats: Dict[str, int] = None) -> str:
+        """查找标签类别（未命中返回 None）
+        
+        提供 stats 时记录布隆过滤器直接拦截的未命中次数（bloom_rejections）
+        和通过过滤器但实际不存在的次数（bloom_false_positives）。
+        """
+        category = self._builtin_index.get(tag)
+        if category is not None or not isinstance(tag, str):
+            return category
+        bloom = self._bloom
+        if bloom is not None and tag not in bloom:
+            if stats is not None:
+                stats["bloom_rejections"] += 1
+            return None
+        position = self._tags.find(tag)
+        if position < 0:
+            if bloom is not None and stats is not None:
+                stats["bloom_false_positives"] += 1
+            return None
+        return self._mask_categories[self._masks[position]]
+    
+    def __getitem__(self, tag: str) -> str:
+        category = self.get(tag)
+        if category is None:
+            raise KeyError(tag)
+        return category
+    
+    def __contains__(self, tag) -> bool:
+        return self.get(tag) is not None
+    
+    def __iter__(self) -> Iterator[str]:
+        yield from self._builtin_index
+        for position, tag in enumerate(self._tags):
+            if self._mask_categories[self._masks[position]] is not None and tag not in self._builtin_index:
+                yield tag
+    
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class TagAutomaton:
+    """基于 Aho-Corasick 的多模式标签提取器
+    
+    文本先切分为词元：ASCII 单词为一个词元，其余字符（中日韩文字、标点）各为一个词元，
+    因此英文标签只会按完整单词匹配（hair 不会命中 chair），中日文别名可在任意位置命中。
+    状态转移保存在一个以 (状态, 词元编号) 编码的整数为键的字典中，失败链接使用 array，
+    以控制数万模式时的内存占用。一次线性扫描即可找出所有命中的标签。
+    """
+    
+    TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?|[^\sa-z0-9]")
+    
+    def __init__(self, patterns: Dict[str, str]):
+        """patterns: 模式文本 → 输出标签"""
+        self._token_ids = {}
+        self._goto = {}
+        self._outputs = [None]
+        self._depths = array('i', [0])
+        
+        for pattern, tag in patterns.items():
+            tokens = self.tokenize(pattern)
+            if not tokens:
+                continue
+            state = 0
+            for token in tokens:
+                key = self._transition_key(state, self._token_ids.setdefault(token, len(self._token_ids)))
+                next_state = self._goto.get(key)
+                if next_state is None:
+                    next_state = len(self._outputs)
+                    self._goto[key] = next_state
+                    self._outputs.append(None)
+                    self._depths.append(self._depths[state] + 1)
+                state = next_state
+            if self._outputs[state] is None:
+                self._outputs[state] = tag
+        
+        self._build_failure_links()
+    
+    def _transition_key(self, state: int, token_id: int) -> int:
+        return state * 0x100000 + token_id
+    
+    def _build_failure_links(self):
+        """按深度（BFS顺序）计算失败链接和输出链接"""
+        state_count = len(self._outputs)
+        self._fail = array('i', bytes(4 * state_count))
+        self._output_links = array('i', bytes(4 * state_count))
+        
+        edges = sorted(self._goto.items(), key=lambda item: self._depths[item[1]])
+        for key, state in edges:
+            parent, token_id = divmod(key, 0x100000)
+            if parent:
+                fallback = self._fail[parent]
+                while True:
+                    target = self._goto.get(self._transition_key(fallback, token_id))
+                    if target is not None or not fallback:
+                        break
+                    fallback = self._fail[fallback]
+                self._fail[state] = target or 0
+            
+            fail_state = self._fail[state]
+            self._output_links[state] = fail_state if self._outputs[fail_state] is not None else self._output_links[fail_state]
+    
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        """统一的词元切分（小写，下划线视为空格）"""
+        return cls.TOKEN_PATTERN.findall(text.lower().replace('_', ' '))
+    
+    def extract(self, text: str) -> Tuple[List[str], bool]:
+        """从自由文本中提取已知标签
+        
+        返回 (标签列表, 是否还有未识别的文字)。重叠的命中按最左最长原则取舍，
+        标签按出现顺序去重。
+        """
+        tokens = self.tokenize(text)
+        matches = []
+        state = 0
+        
+        for position, token in enumerate(tokens):
+            token_id = self._token_ids.get(token)
+            if token_id is None:
+                state = 0
+                continue
+            
+            while True:
+                next_state = self._goto.get(self._transition_key(state, token_id))
+                if next_state is not None or not state:
+                    break
+                state = self._fail[state]
+            state = next_state or 0
+            
+            output_state = state if self._outputs[state] is not None else self._output_links[state]
+            while output_state:
+                matches.append((position - self._depths[output_state] + 1, position + 1, self._outputs[output_state]))
+                output_state = self._output_links[output_state]
+        
+        # 最左最长、互不重叠
+        matches.sort(key=lambda match: (match[0], match[0] - match[1]))
+        tags = []
+        covered = [False] * len(tokens)
+        cursor = 0
+        for start, end, tag in matches:
+            if start < cursor:
+                continue
+            cursor = end
+            covered[start:end] = [True] * (end - start)
+            if tag not in tags:
+                tags.append(tag)
+        
+        has_residual = any(not is_covered and token.isalnum() for token, is_covered in zip(tokens, covered))
+        return tags, has_residual
+
+
+class TagRuleMatcher:
+    """把按优先级排列的启发式正则规则编译为一个带命名分组的交替式
+    
+    正则交替按从左到右的顺序尝试，第一个匹配的分组即为优先级最高的规则，
+    因此一次 match 就能得到与逐条匹配完全相同的结果。
+    连续的同类别 `.*<后缀>$` 规则会合并为一个后缀分组，避免每条规则重复扫描整个标签。
+    """
+    
+    SUFFIX_RULE = re.compile(r"^\.\*([\w:\-]+)\$$")
+    
+    def __init__(self, rules: List[Tuple[str, Any]]):
+        alternatives = []
+        for category, pattern in rules:
+            source = pattern.pattern if hasattr(pattern, 'pattern') else pattern
+            suffix = self.SUFFIX_RULE.match(source)
+            if suffix and alternatives and alternatives[-1][0] == category and alternatives[-1][2] is not None:
+                alternatives[-1][2].append(suffix.group(1))
+            else:
+                alternatives.append([category, source, [suffix.group(1)] if suffix else None])
+        
+        self._categories = {}
+        parts = []
+        for position, (category, source, suffixes) in enumerate(alternatives):
+            group = f"rule{position}"
+            if suffixes is not None:
+                source = ".*(?:" + "|".join(re.escape(suffix) for suffix in suffixes) + ")$"
+            self._categories[group] = category
+            parts.append(f"(?P<{group}>{source})")
+        self._pattern = re.compile("|".join(parts)) if parts else None
+    
+    def match(self, text: str) -> str:
+        """返回第一条匹配规则的类别，没有规则匹配时返回 None"""
+        if self._pattern is None:
+            return None
+        matched = self._pattern.match(text)
+        return self._categories[matched.lastgroup] if matched else None
+
+
 class AdvancedPromptProcessor:
     """
     高级提示词处理器 - 综合处理节点
@@ -79,8 +902,74 @@ class AdvancedPromptProcessor:
     
     # 类变量：将内置标签数据移到类级别，避免每次实例化重复创建
     _TAG_DATABASE = None
+    # 规范化绝对路径 → (内容版本, 知识库)；发布与在途加载登记均在锁内完成
     _KNOWLEDGE_CACHE = {}
+    _RESOLVED_KNOWLEDGE_PATHS = {}
+    _KNOWLEDGE_CACHE_LOCK = threading.Lock()
+    _KNOWLEDGE_LOADS_IN_FLIGHT = {}
+    # 热重载：被监视的知识库文件夹及轮询线程
+    _WATCHED_KNOWLEDGE_PATHS = set()
+    _KNOWLEDGE_WATCHER = None
     _COMPILED_PATTERNS = None
+    _COMPILED_INDEX_CACHE = {}
+    _THEME_AUTOMATON_CACHE = {}
+    # 正在后台构建主题提取自动机的知识库（id → 知识库）
+    _THEME_AUTOMATON_BUILDS = {}
+    _THEME_AUTOMATON_BUILDS_LOCK = threading.Lock()
+    _FUZZY_INDEX_CACHE = {}
+    # 编译索引查找统计（进程内累计，每次分类调用结束后在锁内合并）
+    _LOOKUP_STATS = {"hits": 0, "misses": 0, "bloom_rejections": 0, "bloom_false_positives": 0}
+    _LOOKUP_STATS_LOCK = threading.Lock()
+    
+    # 标签分类类别（输出顺序）
+    TAG_CATEGORIES = ("special", "characters", "copyrights", "artists", "general", "quality", "meta", "rating")
+    # 外部知识库合并时的优先级顺序（同一标签只归入第一个出现的类别）
+    KNOWLEDGE_PRIORITY_ORDER = ("special", "quality", "rating", "meta", "characters", "copyrights", "artists", "general")
+    # 分类时的知识库查找顺序（与 classify_single_tag_with_knowledge 的检查顺序一致）
+    KNOWLEDGE_LOOKUP_ORDER = ("special", "quality", "rating", "general", "characters", "copyrights", "artists", "meta")
+    # 编译索引缓存的最大条目数
+    MAX_COMPILED_INDEX_CACHE = 8
+    # 批量分类时单个标签分类结果的缓存上限（超过后清空重建，保持内存平稳）
+    MAX_BATCH_MEMO_SIZE = 200000
+    
+    # 知识库文件夹中各类别的候选文件名（按顺序取第一个存在的文件）
+    KNOWLEDGE_CATEGORY_FILES = {
+        "special": ["special.csv", "人数标签.csv"],
+        "characters": ["characters.csv", "角色.csv", "character.csv"],
+        "copyrights": ["copyrights.csv", "版权.csv", "copyright.csv"],
+        "artists": ["artists.csv", "画师.csv", "artist.csv"],
+        "general": ["general.csv", "通用.csv"],
+        "quality": ["quality.csv", "质量.csv"],
+        "meta": ["meta.csv", "元数据.csv", "metadata.csv"],
+        "rating": ["rating.csv", "评级.csv"]
+    }
+    KNOWLEDGE_GENERAL_FILE = "knowledge_base.csv"
+    # 带类别代码、使用次数和多语言别名的 Danbooru 标签表
+    KNOWLEDGE_ALIAS_FILE = "danbooru_tags.csv"
+    # 热重载：后台轮询知识库文件变化，设为 False 可关闭（之后只能调用 reload_knowledge_base 重新加载）
+    KNOWLEDGE_HOT_RELOAD = True
+    # 知识库存储模式：memory 还原为 Python 集合；mmap 直接映射快照文件，多个进程共享同一份页缓存；
+    # auto 在不重复的已知标签数达到 KNOWLEDGE_MMAP_THRESHOLD 时自动使用 mmap（首次解析CSV与读取快照的判断一致）
+    KNOWLEDGE_STORAGE_MODE = os.environ.get("ADVANCED_PROMPT_KNOWLEDGE_STORAGE", "auto").strip().lower()
+    KNOWLEDGE_MMAP_THRESHOLD = 300000
+    KNOWLEDGE_WATCH_INTERVAL = 2.0
+    
+    # 绘图主题提取：画师名和拉丁字母别名容易与普通英文单词冲突（如 air、at），不参与自由文本匹配
+    THEME_EXCLUDED_CATEGORIES = ("artists",)
+    THEME_MIN_PATTERN_LENGTH = 3
+    THEME_MIN_ALIAS_LENGTH = 2
+    THEME_MAX_PATTERNS = 300000
+    # 自动机构建完成前按这些分隔符切分主题，逐段查找
+    THEME_SEGMENT_PATTERN = re.compile(r"[,，、;；\n]+")
+    # 只对普通英文标签做拼写纠错（排除带权重、括号、冒号前缀等写法）
+    FUZZY_CORRECTABLE_PATTERN = re.compile(r"^[a-z][a-z0-9_'\-]*$")
+    
+    _COPYRIGHT_KEYWORDS = frozenset({
+        "vocaloid", "touhou", "fate", "pokemon", "naruto", "bleach", "one_piece",
+        "dragon_ball", "attack_on_titan", "demon_slayer", "jujutsu_kaisen", 
+        "genshin_impact", "honkai_impact", "azur_lane", "kantai_collection",
+        "love_live", "idolmaster", "persona", "final_fantasy", "overwatch"
+    })
     
     # 常量定义
     KNOWLEDGE_BASE_PATH = "Tag knowledge"
@@ -141,6 +1030,14 @@ class AdvancedPromptProcessor:
                     "default": "",
                     "placeholder": "HTTPS代理地址(如: http://127.0.0.1:7890)，留空自动检测系统代理"
                 }),
+                "extract_theme_tags": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "从绘图主题中提取已知标签和别名并合并到分类结果；主题完全由标签组成时不再发送主题原文给LLM"
+                }),
+                "fuzzy_tag_correction": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "本地知识库分类前将拼写错误的标签纠正为编辑距离2以内、使用次数最高的已知标签"
+                }),
             },
         }
     
@@ -257,7 +1154,7 @@ class AdvancedPromptProcessor:
         """初始化编译后的正则表达式模式"""
         if cls._COMPILED_PATTERNS is None:
             import re
-            cls._COMPILED_PATTERNS = {
+            patterns = {
                 'character_patterns': [
                     re.compile(r"^\w+\s+\(\w+\)$"),  # 角色名 (作品名)
                     re.compile(r"^\w+_\w+_\w+$"),    # 三段式角色名
@@ -274,6 +1171,16 @@ class AdvancedPromptProcessor:
                     re.compile(r"artist:\w+"),       # artist:画师名
                 ]
             }
+            # 合并后的规则：非角色后缀规则作用于小写标签，形状规则（角色优先于画师）作用于原始标签
+            patterns['non_character_rules'] = TagRuleMatcher(
+                [("general", pattern) for pattern in patterns['non_character_patterns']]
+            )
+            patterns['shape_rules'] = TagRuleMatcher(
+                [("characters", pattern) for pattern in patterns['character_patterns']]
+                + [("artists", pattern) for pattern in patterns['artist_patterns']]
+            )
+            # 全部键构建完成后一次性发布，并发读取者不会看到缺少规则的字典
+            cls._COMPILED_PATTERNS = patterns
         return cls._COMPILED_PATTERNS
     
     @property
@@ -284,12 +1191,7 @@ class AdvancedPromptProcessor:
     @property  
     def copyright_keywords(self):
         """版权作品关键词"""
-        return {
-            "vocaloid", "touhou", "fate", "pokemon", "naruto", "bleach", "one_piece",
-            "dragon_ball", "attack_on_titan", "demon_slayer", "jujutsu_kaisen", 
-            "genshin_impact", "honkai_impact", "azur_lane", "kantai_collection",
-            "love_live", "idolmaster", "persona", "final_fantasy", "overwatch"
-        }
+        return self._COPYRIGHT_KEYWORDS
     
     @property
     def character_patterns(self):
@@ -305,6 +1207,16 @@ class AdvancedPromptProcessor:
     def artist_patterns(self):
         """获取编译后的画师匹配模式"""
         return self._init_patterns()['artist_patterns']
+    
+    @property
+    def non_character_rules(self) -> TagRuleMatcher:
+        """获取合并后的非角色后缀规则"""
+        return self._init_patterns()['non_character_rules']
+    
+    @property
+    def shape_rules(self) -> TagRuleMatcher:
+        """获取合并后的角色/画师形状规则"""
+        return self._init_patterns()['shape_rules']
 
     def __init__(self):
         # 轻量级初始化
@@ -320,15 +1232,30 @@ class AdvancedPromptProcessor:
         return tag.strip().lower().replace(' ', '_')
     
     @staticmethod
-    def parse_tags_from_string(text: str) -> list:
-        """从文本中解析标签列表"""
+    def alias_key(alias: str) -> str:
+        """别名索引的查找键（与 clean_tag 的规则一致）"""
+        return AdvancedPromptProcessor.clean_tag(alias)
+    
+    @staticmethod
+    def parse_tags_from_string(text: str, aliases: Dict[str, str] = None) -> list:
+        """从文本中解析标签列表，提供别名索引时将别名解析为标准标签"""
         if not text.strip():
             return []
-        return [AdvancedPromptProcessor.clean_tag(tag) for tag in text.split(',') if tag.strip()]
+        tags = [AdvancedPromptProcessor.clean_tag(tag) for tag in text.split(',') if tag.strip()]
+        if aliases:
+            tags = [aliases.get(tag, tag) for tag in tags]
+        return tags
     
-    def parse_custom_tags(self, custom_text: str) -> list:
-        """解析自定义标签文本（逗号分隔）"""
-        return self.parse_tags_from_string(custom_text)
+    def parse_custom_tags(self, custom_text: str, knowledge_base: Dict = None) -> list:
+        """解析自定义标签文本（逗号分隔）
+        
+        别名只按传入的或已加载的知识库解析，不会为此触发知识库加载。
+        """
+        if not custom_text.strip():
+            return []
+        if knowledge_base is None:
+            knowledge_base = self.get_loaded_knowledge_base(self.KNOWLEDGE_BASE_PATH)
+        return self.parse_tags_from_string(custom_text, getattr(knowledge_base, 'aliases', None))
 
     def clean_and_validate_url(self, url: str) -> str:
         """清理和验证API URL"""
@@ -391,75 +1318,296 @@ class AdvancedPromptProcessor:
             return "copyrights"
         
         # 首先检查非角色模式，防止误分类
-        for pattern in self.non_character_patterns:
-            if pattern.match(tag_lower):
-                return "general"
+        if self.non_character_rules.match(tag_lower):
+            return "general"
         
         # 基于模式匹配
-        for pattern in self.character_patterns:
-            if pattern.match(tag):
-                return "characters"
-        
-        for pattern in self.artist_patterns:
-            if pattern.match(tag):
-                return "artists"
+        category = self.shape_rules.match(tag)
+        if category is not None:
+            return category
         
         return "general"
 
     def load_knowledge_base_from_folder(self, folder_path: str) -> Dict[str, Dict]:
-        """从文件夹加载知识库（带缓存）"""
-        # 检查缓存
-        if folder_path in self._KNOWLEDGE_CACHE:
-            return self._KNOWLEDGE_CACHE[folder_path]
+        """从文件夹加载知识库（带缓存，线程安全）
+        
+        缓存按规范化的绝对路径保存已发布的知识库及其源文件版本，命中时只做一次字典查找，
+        不检查文件；源文件的变化由热重载线程或 reload_knowledge_base 检测并在后台重新加载。
+        多个线程同时未命中时只有第一个线程执行加载，其余线程等待同一结果。
+        """
+        if not folder_path:
+            return {}
         
-        knowledge_base = self._load_knowledge_base_internal(folder_path)
+        folder_path = self._resolved_knowledge_path(folder_path)
+        with self._KNOWLEDGE_CACHE_LOCK:
+            entry = self._KNOWLEDGE_CACHE.get(folder_path)
+            if entry is not None:
+                return entry[1]
+            pending = self._KNOWLEDGE_LOADS_IN_FLIGHT.get(folder_path)
+            is_loader = pending is None
+            if is_loader:
+                pending = self._KNOWLEDGE_LOADS_IN_FLIGHT[folder_path] = [threading.Event(), {}]
+        
+        if not is_loader:
+            pending[0].wait()
+            return pending[1]
+        
+        knowledge_base = self._publish_knowledge_base(folder_path, self._knowledge_version(folder_path), pending)
+        if self.KNOWLEDGE_HOT_RELOAD:
+            self._watch_knowledge_folder(folder_path)
+        return knowledge_base
+    
+    def reload_knowledge_base(self, folder_path: str) -> Dict[str, Dict]:
+        """检查源文件版本，变化时重新加载
+        
+        已有旧版本时在后台线程中重新加载（优先增量更新），期间调用方继续使用旧版本，不会被阻塞；
+        尚未加载时等同于 load_knowledge_base_from_folder。
+        """
+        if not folder_path:
+            return {}
         
-        # 缓存结果
-        self._KNOWLEDGE_CACHE[folder_path] = knowledge_base
+        folder_path = self._resolved_knowledge_path(folder_path)
+        version = self._knowledge_version(folder_path)
+        with self._KNOWLEDGE_CACHE_LOCK:
+            entry = self._KNOWLEDGE_CACHE.get(folder_path)
+            if entry is not None:
+                if entry[0] != version and folder_path not in self._KNOWLEDGE_LOADS_IN_FLIGHT:
+                    pending = self._KNOWLEDGE_LOADS_IN_FLIGHT[folder_path] = [threading.Event(), {}]
+                    threading.Thread(target=self._publish_knowledge_base,
+                                     args=(folder_path, version, pending, entry),
+                                     name="TagKnowledgeReload", daemon=True).start()
+                return entry[1]
+        return self.load_knowledge_base_from_folder(folder_path)
+    
+    def get_loaded_knowledge_base(self, folder_path: str) -> Dict[str, Dict]:
+        """返回该路径已发布的知识库（可能是旧版本），尚未加载时返回 None，不触发加载"""
+        if not folder_path:
+            return None
+        entry = self._KNOWLEDGE_CACHE.get(self._resolved_knowledge_path(folder_path))
+        return entry[1] if entry is not None else None
+    
+    @classmethod
+    def _resolved_knowledge_path(cls, folder_path: str) -> str:
+        """resolve_knowledge_path 的结果按原始路径缓存，缓存命中时不访问文件系统"""
+        resolved = cls._RESOLVED_KNOWLEDGE_PATHS.get(folder_path)
+        if resolved is None:
+            resolved = cls._RESOLVED_KNOWLEDGE_PATHS[folder_path] = cls.resolve_knowledge_path(folder_path)
+        return resolved
+    
+    def _publish_knowledge_base(self, folder_path: str, version: Tuple, pending: List, previous: Tuple = None):
+        """加载（有旧版本时优先增量更新）并原子发布知识库（previous 为旧的 (版本, 知识库)）"""
+        knowledge_base = None
+        incremental = False
+        try:
+            if previous is not None:
+                knowledge_base = self._apply_knowledge_delta(folder_path, previous[0], previous[1], version)
+                incremental = knowledge_base is not None
+            if knowledge_base is None:
+                knowledge_base = self._load_knowledge_base_internal(folder_path)
+        except Exception as e:
+            self.safe_log(f"重新加载知识库失败: {e}", "error")
+        finally:
+            if knowledge_base is None:
+                # 重新加载失败时继续使用旧版本
+                knowledge_base = previous[1] if previous is not None else {}
+            with self._KNOWLEDGE_CACHE_LOCK:
+                # 同一路径的旧版本不再使用，发布新版本时一并替换
+                stale_entry = self._KNOWLEDGE_CACHE.get(folder_path)
+                self._KNOWLEDGE_CACHE[folder_path] = (version, knowledge_base)
+                del self._KNOWLEDGE_LOADS_IN_FLIGHT[folder_path]
+            pending[1] = knowledge_base
+            pending[0].set()
+            if stale_entry is not None and stale_entry[1] is not knowledge_base:
+                self._retire_knowledge_base(stale_entry[1])
+        
+        if incremental:
+            # 发布后再刷新磁盘快照，下次启动时可直接使用
+            snapshot_path = os.path.join(folder_path, TagKnowledgeSnapshot.FILENAME)
+            self._write_knowledge_snapshot(snapshot_path, [list(entry) for entry in version], knowledge_base)
+        
+        return knowledge_base
+    
+    @classmethod
+    def _retire_knowledge_base(cls, knowledge_base: Dict):
+        """移除已被替换的知识库的派生数据；快照支撑的知识库在不再被引用后关闭映射
+        
+        仍在使用旧版本的分类调用不受影响，映射在最后一个引用释放时才关闭。
+        """
+        for cache in (cls._COMPILED_INDEX_CACHE, cls._FUZZY_INDEX_CACHE, cls._THEME_AUTOMATON_CACHE):
+            if cls._cached_knowledge_derivative(cache, knowledge_base) is not None:
+                cache.pop(id(knowledge_base), None)
+        snapshot = getattr(knowledge_base, 'snapshot', None)
+        if snapshot is not None:
+            weakref.finalize(knowledge_base, snapshot.close)
+    
+    @classmethod
+    def _watch_knowledge_folder(cls, folder_path: str):
+        """登记需要热重载的知识库文件夹，并按需启动轮询线程"""
+        with cls._KNOWLEDGE_CACHE_LOCK:
+            cls._WATCHED_KNOWLEDGE_PATHS.add(folder_path)
+            if cls._KNOWLEDGE_WATCHER is not None and cls._KNOWLEDGE_WATCHER.is_alive():
+                return
+            cls._KNOWLEDGE_WATCHER = threading.Thread(target=cls._knowledge_watch_loop,
+                                                      name="TagKnowledgeWatcher", daemon=True)
+            cls._KNOWLEDGE_WATCHER.start()
+    
+    @classmethod
+    def _knowledge_watch_loop(cls):
+        """轮询源文件指纹，变化时触发后台重新加载（请求路径上不检查文件）"""
+        processor = cls()
+        while cls.KNOWLEDGE_HOT_RELOAD:
+            time.sleep(cls.KNOWLEDGE_WATCH_INTERVAL)
+            for folder_path in list(cls._WATCHED_KNOWLEDGE_PATHS):
+                try:
+                    processor.reload_knowledge_base(folder_path)
+                except Exception as e:
+                    processor.safe_log(f"知识库热重载检查失败: {e}", "warning")
+    
+    def _apply_knowledge_delta(self, folder_path: str, previous_version: Tuple,
+                               previous_kb: Dict, version: Tuple) -> "TagKnowledgeBase":
+        """只重新解析发生变化的类别文件，生成新知识库并增量更新派生索引
+        
+        仅当变化限于各类别当前使用的文件时可以增量更新；通用知识库、别名文件变化或
+        类别改用其他候选文件时返回 None，由调用方完整重新加载。
+        """
+        # mmap 模式的知识库由快照文件支撑，直接完整重新加载（重写并映射新快照）
+        if not isinstance(previous_kb, TagKnowledgeBase) or isinstance(previous_kb, MappedTagKnowledgeBase):
+            return None
+        
+        previous_entries = {entry[0]: entry[1:] for entry in previous_version}
+        entries = {entry[0]: entry[1:] for entry in version}
+        changed_files = {name for name in previous_entries.keys() | entries.keys()
+                         if previous_entries.get(name) != entries.get(name)}
+        
+        changed_categories = {}
+        for category, possible_names in self.KNOWLEDGE_CATEGORY_FILES.items():
+            previous_file = next((name for name in possible_names if name in previous_entries), None)
+            current_file = next((name for name in possible_names if name in entries), None)
+            if previous_file != current_file:
+                return None
+            if current_file in changed_files:
+                changed_categories[category] = current_file
+                changed_files.discard(current_file)
+        
+        # 未被使用的候选文件（被同类别优先级更高的文件遮蔽）的变化可以忽略
+        category_names = {name for names in self.KNOWLEDGE_CATEGORY_FILES.values() for name in names}
+        if changed_files - category_names:
+            return None
+        
+        general_knowledge = {}
+        general_csv = os.path.join(folder_path, self.KNOWLEDGE_GENERAL_FILE)
+        if changed_categories and os.path.exists(general_csv):
+            general_knowledge = self._load_csv_knowledge_base(general_csv)
+        
+        categories = dict(previous_kb)
+        changed_tags = set()
+        for category, filename in changed_categories.items():
+            tags = self._load_category_csv_file(os.path.join(folder_path, filename))
+            tags.update(general_knowledge.get(category, ()))
+            previous_tags = previous_kb.get(category, frozenset())
+            added, removed = tags - previous_tags, previous_tags - tags
+            if added or removed:
+                categories[category] = frozenset(tags)
+                changed_tags.update(added)
+                changed_tags.update(removed)
+                self.safe_log(f"知识库热重载 {filename}: 新增 {len(added)} 个, 移除 {len(removed)} 个标签")
+        
+        aliases, tag_counts = previous_kb.aliases, previous_kb.tag_counts
+        if previous_kb.snapshot is not None:
+            # 旧快照在旧知识库退役后关闭，新知识库不能继续引用其上的视图
+            aliases = dict(aliases.items())
+            tag_counts = {tag: count for tag, count in tag_counts.items() if count}
+        knowledge_base = TagKnowledgeBase(categories, aliases, tag_counts)
+        self._patch_knowledge_derivatives(previous_kb, knowledge_base, changed_tags)
         return knowledge_base
     
+    @classmethod
+    def _patch_knowledge_derivatives(cls, previous_kb: Dict, knowledge_base: Dict, changed_tags: set):
+        """将旧知识库的派生索引迁移到新知识库，只重新计算发生变化的标签"""
+        # 编译索引复制后再修改，正在使用旧索引的分类和自动机构建不会看到迭代中的字典变化
+        previous_index = cls._cached_knowledge_derivative(cls._COMPILED_INDEX_CACHE, previous_kb)
+        if previous_index is not None:
+            tag_index = dict(previous_index)
+            for tag in changed_tags:
+                category = cls._index_category(tag, knowledge_base)
+                if category is None:
+                    tag_index.pop(tag, None)
+                else:
+                    tag_index[tag] = category
+            cls._register_knowledge_derivative(cls._COMPILED_INDEX_CACHE, knowledge_base, tag_index)
+        
+        fuzzy_index = cls._cached_knowledge_derivative(cls._FUZZY_INDEX_CACHE, previous_kb)
+        if fuzzy_index is not None:
+            known = lambda tag: any(tag in tags for tags in knowledge_base.values())
+            was_known = lambda tag: any(tag in tags for tags in previous_kb.values())
+            added = [tag for tag in changed_tags if known(tag) and not was_known(tag)]
+            removed = [tag for tag in changed_tags if was_known(tag) and not known(tag)]
+            cls._register_knowledge_derivative(
+                cls._FUZZY_INDEX_CACHE, knowledge_base,
+                fuzzy_index.with_changes(added, removed, knowledge_base.tag_counts)
+            )
+        
+        # 自动机的失败链接依赖全部模式，直接重建（在后台重载线程中完成）
+        if cls._cached_knowledge_derivative(cls._THEME_AUTOMATON_CACHE, previous_kb) is not None:
+            cls.get_theme_automaton(knowledge_base)
+    
+    @classmethod
+    def _index_category(cls, tag: str, knowledge_base: Dict = None) -> str:
+        """按 _compile_tag_index 的合并规则计算单个标签在编译索引中的类别"""
+        candidates = {category for category, tags in cls._init_tag_database().items() if tag in tags}
+        if knowledge_base:
+            for category in cls.KNOWLEDGE_PRIORITY_ORDER:
+                if tag in knowledge_base.get(category, ()):
+                    candidates.add(category)
+                    break
+        return next((category for category in cls.KNOWLEDGE_LOOKUP_ORDER if category in candidates), None)
+    
+    @staticmethod
+    def resolve_knowledge_path(folder_path: str) -> str:
+        """将知识库路径规范化为绝对路径（相对路径基于插件目录）"""
+        if not os.path.isabs(folder_path):
+            plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            folder_path = os.path.join(plugin_dir, folder_path)
+        return os.path.normcase(os.path.realpath(folder_path))
+    
+    @classmethod
+    def _knowledge_version(cls, folder_path: str) -> Tuple:
+        """知识库源文件的内容版本（可哈希的文件指纹）"""
+        return tuple(tuple(entry) for entry in cls._knowledge_fingerprint(folder_path))
+    
     def _load_knowledge_base_internal(self, folder_path: str) -> Dict[str, Dict]:
         """从文件夹加载知识库（自动读取所有相关文件）"""
         if not folder_path:
             return {}
         
         # 确保路径是相对于插件目录的
-        if not os.path.isabs(folder_path):
-            plugin_dir = os.path.dirname(os.path.dirname(__file__))
-            folder_path = os.path.join(plugin_dir, folder_path)
+        folder_path = self.resolve_knowledge_path(folder_path)
         
         if not os.path.exists(folder_path):
             self.safe_log(f"知识库文件夹不存在: {folder_path}", "warning")
             return {}
         
-        knowledge_base = {
-            "special": set(),
-            "characters": set(),
-            "copyrights": set(),
-            "artists": set(),
-            "general": set(),
-            "quality": set(),
-            "meta": set(),
-            "rating": set()
-        }
+        # 优先使用磁盘快照（源文件的大小和修改时间未变化时有效）
+        snapshot_path = os.path.join(folder_path, TagKnowledgeSnapshot.FILENAME)
+        fingerprint = self._knowledge_fingerprint(folder_path)
+        snapshot = TagKnowledgeSnapshot.open(snapshot_path, fingerprint)
+        if snapshot is not None:
+            try:
+                knowledge_base = self._knowledge_base_from_snapshot(snapshot)
+                self.safe_log(f"从知识库快照加载了 {snapshot.header['tag_count']} 个标签, "
+                              f"{snapshot.header['alias_count']} 个别名")
+                return knowledge_base
+            except Exception as e:
+                self.safe_log(f"读取知识库快照失败，重新解析CSV: {e}", "warning")
+                snapshot.close()
+        
+        knowledge_base = {category: set() for category in self.TAG_CATEGORIES}
         
         try:
-            # 预定义的文件名映射
-            category_files = {
-                "special": ["special.csv", "人数标签.csv"],
-                "characters": ["characters.csv", "角色.csv", "character.csv"],
-                "copyrights": ["copyrights.csv", "版权.csv", "copyright.csv"],
-                "artists": ["artists.csv", "画师.csv", "artist.csv"],
-                "general": ["general.csv", "通用.csv"],
-                "quality": ["quality.csv", "质量.csv"],
-                "meta": ["meta.csv", "元数据.csv", "metadata.csv"],
-                "rating": ["rating.csv", "评级.csv"]
-            }
-            
             loaded_files = []
             
             # 加载每个类别的文件
-            for category, possible_names in category_files.items():
+            for category, possible_names in self.KNOWLEDGE_CATEGORY_FILES.items():
                 for filename in possible_names:
                     file_path = os.path.join(folder_path, filename)
                     if os.path.exists(file_path):
@@ -469,23 +1617,79 @@ class AdvancedPromptProcessor:
                         break  # 找到一个就跳出
             
             # 检查是否有通用的knowledge_base.csv文件
-            general_csv = os.path.join(folder_path, "knowledge_base.csv")
+            general_csv = os.path.join(folder_path, self.KNOWLEDGE_GENERAL_FILE)
             if os.path.exists(general_csv):
                 general_knowledge = self._load_csv_knowledge_base(general_csv)
                 for category, tags in general_knowledge.items():
                     if category in knowledge_base:
                         knowledge_base[category].update(tags)
-                loaded_files.append("knowledge_base.csv")
+                loaded_files.append(self.KNOWLEDGE_GENERAL_FILE)
+            
+            # 加载多语言别名索引和标签使用次数
+            aliases = {}
+            tag_counts = {}
+            alias_csv = os.path.join(folder_path, self.KNOWLEDGE_ALIAS_FILE)
+            if os.path.exists(alias_csv):
+                aliases = self._load_alias_csv_file(alias_csv, knowledge_base, tag_counts)
+                loaded_files.append(self.KNOWLEDGE_ALIAS_FILE)
             
             self.safe_log(f"从知识库文件夹加载了 {len(loaded_files)} 个文件: {', '.join(loaded_files)}")
             
-            # 转换为字典格式
-            return {category: tags for category, tags in knowledge_base.items()}
+            knowledge_base = TagKnowledgeBase(knowledge_base, aliases, tag_counts)
+            # 与快照头部的 tag_count 一致：按不重复的标签计数（同一标签可能属于多个类别）
+            if not self._use_mapped_storage(len(frozenset().union(*knowledge_base.values()))):
+                # 内存存储时快照在后台写出，不占用首次加载的时间
+                threading.Thread(target=self._write_knowledge_snapshot,
+                                 args=(snapshot_path, fingerprint, knowledge_base),
+                                 name="TagKnowledgeSnapshotWriter", daemon=True).start()
+            elif self._write_knowledge_snapshot(snapshot_path, fingerprint, knowledge_base):
+                # mmap 存储时改为映射刚写出的快照，解析得到的集合随即释放
+                snapshot = TagKnowledgeSnapshot.open(snapshot_path, fingerprint)
+                if snapshot is not None:
+                    knowledge_base = MappedTagKnowledgeBase(snapshot)
+            
+            return knowledge_base
             
         except Exception as e:
             self.safe_log(f"加载知识库文件夹失败: {e}", "error")
             return {}
     
+    def _write_knowledge_snapshot(self, snapshot_path: str, fingerprint: List, knowledge_base: Dict) -> bool:
+        """写出知识库快照，失败时记录警告"""
+        if TagKnowledgeSnapshot.write(snapshot_path, fingerprint, knowledge_base, self.TAG_CATEGORIES):
+            return True
+        self.safe_log(f"知识库快照写入失败: {snapshot_path}", "warning")
+        return False
+    
+    def _knowledge_base_from_snapshot(self, snapshot: TagKnowledgeSnapshot) -> TagKnowledgeBase:
+        """按存储模式从快照构建知识库"""
+        if self._use_mapped_storage(snapshot.header["tag_count"]):
+            return MappedTagKnowledgeBase(snapshot)
+        return snapshot.to_knowledge_base()
+    
+    @classmethod
+    def _use_mapped_storage(cls, tag_count: int) -> bool:
+        """根据存储模式和标签数量决定是否使用 mmap 存储"""
+        if cls.KNOWLEDGE_STORAGE_MODE == "auto":
+            return tag_count >= cls.KNOWLEDGE_MMAP_THRESHOLD
+        return cls.KNOWLEDGE_STORAGE_MODE == "mmap"
+    
+    @classmethod
+    def _knowledge_fingerprint(cls, folder_path: str) -> List:
+        """计算知识库源文件指纹（文件名、大小、修改时间），用于判断快照是否过期"""
+        candidates = [name for names in cls.KNOWLEDGE_CATEGORY_FILES.values() for name in names]
+        candidates.append(cls.KNOWLEDGE_GENERAL_FILE)
+        candidates.append(cls.KNOWLEDGE_ALIAS_FILE)
+        
+        fingerprint = []
+        for filename in candidates:
+            try:
+                stat = os.stat(os.path.join(folder_path, filename))
+            except OSError:
+                continue
+            fingerprint.append([filename, stat.st_size, stat.st_mtime_ns])
+        return fingerprint
+    
     def _load_category_csv_file(self, file_path: str) -> set:
         """加载单个类别的CSV文件"""
         import csv
@@ -547,6 +1751,64 @@ class AdvancedPromptProcessor:
         
         return tags
     
+    def _load_alias_csv_file(self, file_path: str, knowledge_base: Dict[str, set],
+                             tag_counts: Dict[str, int] = None) -> Dict[str, str]:
+        """从 danbooru_tags.csv 的 alias 列构建 别名 → 标准标签 索引
+        
+        同一别名对应多个标签时取使用次数(count)最高的标签；与已知标签、内置数据库标签
+        或版权关键词重名的别名会被忽略，保证已知标签永远不会被改写（如 fate 不会变成 fate_(series)）。
+        提供 tag_counts 时同时记录每个标签的使用次数。
+        """
+        import csv
+        aliases = {}
+        alias_counts = {}
+        canonical_tags = set()
+        
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                csv_reader = csv.reader(f)
+                fieldnames = next(csv_reader, None) or []
+                if 'tag' not in fieldnames or 'alias' not in fieldnames:
+                    self.safe_log(f"警告: 别名文件缺少tag或alias列 {file_path}", "warning")
+                    return {}
+                # 按列下标读取（比 DictReader 逐行建字典快得多，这是冷启动加载中最大的一项）
+                tag_column = fieldnames.index('tag')
+                alias_column = fieldnames.index('alias')
+                count_column = fieldnames.index('count') if 'count' in fieldnames else None
+                alias_key = self.alias_key
+                
+                for row in csv_reader:
+                    tag = row[tag_column].strip().lower() if len(row) > tag_column else ''
+                    if not tag:
+                        continue
+                    canonical_tags.add(tag)
+                    
+                    try:
+                        count = int(row[count_column] or 0) if count_column is not None and len(row) > count_column else 0
+                    except ValueError:
+                        count = 0
+                    if tag_counts is not None and count > tag_counts.get(tag, 0):
+                        tag_counts[tag] = count
+                    
+                    alias_text = row[alias_column] if len(row) > alias_column else ''
+                    if not alias_text:
+                        continue
+                    for alias in alias_text.split(','):
+                        key = alias_key(alias)
+                        if key and key != tag and count > alias_counts.get(key, -1):
+                            aliases[key] = tag
+                            alias_counts[key] = count
+        except Exception as e:
+            self.safe_log(f"加载别名文件失败 {file_path}: {e}", "error")
+            return {}
+        
+        for tags in knowledge_base.values():
+            canonical_tags.update(tags)
+        for tags in self._init_tag_database().values():
+            canonical_tags.update(self.alias_key(tag) for tag in tags)
+        canonical_tags.update(self.alias_key(keyword) for keyword in self._COPYRIGHT_KEYWORDS)
+        return {alias: tag for alias, tag in aliases.items() if alias not in canonical_tags}
+    
     def _load_csv_knowledge_base(self, file_path: str) -> Dict[str, Dict]:
         """加载CSV格式的知识库"""
         import csv
@@ -693,77 +1955,379 @@ class AdvancedPromptProcessor:
             return self.classify_tags(tags, set(), set(), set())
 
     def classify_tags_with_knowledge_base(self, tags: str, knowledge_base: Dict, 
-                                        custom_chars: set, custom_artists: set, custom_copyrights: set) -> Dict[str, List[str]]:
+                                        custom_chars: set, custom_artists: set, custom_copyrights: set,
+                                        lookup_stats: Dict[str, int] = None) -> Dict[str, List[str]]:
         """使用知识库进行标签分类"""
+        return next(self.classify_tags_batch([tags], knowledge_base, custom_chars, custom_artists, custom_copyrights,
+                                             lookup_stats))
+
+    def classify_tags_batch(self, tag_strings: Iterable[str], knowledge_base: Dict = None,
+                            custom_chars: set = frozenset(), custom_artists: set = frozenset(),
+                            custom_copyrights: set = frozenset(),
+                            lookup_stats: Dict[str, int] = None) -> Iterator[Dict[str, List[str]]]:
+        """批量分类多条逗号分隔的标签字符串
+        
+        所有输入共用同一个编译索引，重复出现的标签只分类一次；
+        结果按输入顺序逐条产出（与 classify_tags_with_knowledge_base 的格式相同），
+        可直接消费大型数据集的迭代器而无需整体载入内存。
+        未提供知识库时使用 KNOWLEDGE_BASE_PATH 下的知识库。
+        提供 lookup_stats 时累加本次调用的查找统计（键同 _LOOKUP_STATS；命中/未命中按标签出现次数计，
+        布隆过滤器的统计只计实际在索引上的查找）。
+        """
+        if knowledge_base is None:
+            knowledge_base = self.load_knowledge_base_from_folder(self.KNOWLEDGE_BASE_PATH)
+        
+        # 合并后的知识库只在每个知识库版本编译一次，分类时只做字典查找
+        tag_index = self.get_compiled_tag_index(knowledge_base)
+        aliases = getattr(knowledge_base, 'aliases', None)
+        # 原始标签 → (解析后的标签, 类别, 是否命中编译索引)
+        memo = {}
+        
+        for tags in tag_strings:
+            classified = {category: [] for category in self.TAG_CATEGORIES}
+            call_stats = dict.fromkeys(self._LOOKUP_STATS, 0)
+            # 已输出的标签 → 是否经过别名解析；别名解析出的标签与同条中的其他标签重复时只保留一个
+            emitted = {}
+            
+            for tag in tags.split(','):
+                tag = tag.strip()
+                if not tag:
+                    continue
+                
+                resolved = memo.get(tag)
+                if resolved is None:
+                    resolved_tag = tag
+                    # 未知标签尝试通过别名解析为标准标签（如 长发 → long_hair）
+                    if aliases and tag.lower() not in tag_index:
+                        resolved_tag = aliases.get(self.alias_key(tag), tag)
+                    hits_before = call_stats["hits"]
+                    category = self.classify_single_tag_with_index(
+                        resolved_tag, tag_index, custom_chars, custom_artists, custom_copyrights, call_stats
+                    )
+                    resolved = (resolved_tag, category, call_stats["hits"] > hits_before)
+                    if len(memo) >= self.MAX_BATCH_MEMO_SIZE:
+                        memo.clear()
+                    memo[tag] = resolved
+                else:
+                    call_stats["hits" if resolved[2] else "misses"] += 1
+                
+                aliased = resolved[0] != tag
+                if resolved[0] in emitted and (aliased or emitted[resolved[0]]):
+                    continue
+                emitted[resolved[0]] = emitted.get(resolved[0], False) or aliased
+                classified[resolved[1]].append(resolved[0])
+            
+            self._merge_lookup_stats(call_stats, lookup_stats)
+            yield classified
+
+    @classmethod
+    def _merge_lookup_stats(cls, call_stats: Dict[str, int], lookup_stats: Dict[str, int] = None):
+        """将一次分类的查找统计合并到进程累计值（以及调用方提供的统计字典）"""
+        with cls._LOOKUP_STATS_LOCK:
+            for key, value in call_stats.items():
+                cls._LOOKUP_STATS[key] += value
+        if lookup_stats is not None:
+            for key, value in call_stats.items():
+                lookup_stats[key] = lookup_stats.get(key, 0) + value
+
+    @classmethod
+    def get_lookup_stats(cls) -> Dict[str, Any]:
+        """返回进程内累计的编译索引查找统计（mmap 模式下包含布隆过滤器的拦截和误判次数）"""
+        with cls._LOOKUP_STATS_LOCK:
+            stats = dict(cls._LOOKUP_STATS)
+        hits, misses = stats["hits"], stats["misses"]
+        stats.update(lookups=hits + misses, hit_rate=hits / (hits + misses) if hits + misses else 0.0)
+        return stats
+
+    @classmethod
+    def reset_lookup_stats(cls):
+        """清零查找统计"""
+        with cls._LOOKUP_STATS_LOCK:
+            for key in cls._LOOKUP_STATS:
+                cls._LOOKUP_STATS[key] = 0
+
+    @classmethod
+    def get_compiled_tag_index(cls, knowledge_base: Dict = None) -> Dict[str, str]:
+        """获取编译后的 tag → 类别 索引（按知识库对象缓存）"""
+        return cls._get_knowledge_derivative(cls._COMPILED_INDEX_CACHE, knowledge_base, cls._compile_tag_index)
+
+    @classmethod
+    def get_theme_automaton(cls, knowledge_base: Dict = None, wait: bool = True) -> TagAutomaton:
+        """获取绘图主题标签提取自动机（按知识库对象缓存）
+        
+        wait=False 时不阻塞：尚未构建时在后台线程中构建并返回 None。
+        """
+        if wait:
+            return cls._get_knowledge_derivative(cls._THEME_AUTOMATON_CACHE, knowledge_base,
+                                                 cls._build_theme_automaton)
+        automaton = cls._cached_knowledge_derivative(cls._THEME_AUTOMATON_CACHE, knowledge_base)
+        if automaton is None:
+            key = id(knowledge_base) if knowledge_base else None
+            with cls._THEME_AUTOMATON_BUILDS_LOCK:
+                if key not in cls._THEME_AUTOMATON_BUILDS:
+                    # 保存知识库引用，构建期间 id 不会被复用
+                    cls._THEME_AUTOMATON_BUILDS[key] = knowledge_base
+                    threading.Thread(target=cls._build_theme_automaton_in_background, args=(knowledge_base,),
+                                     name="TagThemeAutomatonBuilder", daemon=True).start()
+        return automaton
+    
+    @classmethod
+    def _build_theme_automaton_in_background(cls, knowledge_base: Dict):
+        try:
+            cls.get_theme_automaton(knowledge_base)
+        finally:
+            with cls._THEME_AUTOMATON_BUILDS_LOCK:
+                cls._THEME_AUTOMATON_BUILDS.pop(id(knowledge_base) if knowledge_base else None, None)
+
+    @classmethod
+    def get_fuzzy_index(cls, knowledge_base: Dict = None) -> TagFuzzyIndex:
+        """获取标签纠错索引（按知识库对象缓存）"""
+        return cls._get_knowledge_derivative(cls._FUZZY_INDEX_CACHE, knowledge_base, cls._build_fuzzy_index)
+
+    @classmethod
+    def _get_knowledge_derivative(cls, cache: Dict, knowledge_base, builder):
+        """按知识库对象缓存由其派生的数据结构"""
+        derived = cls._cached_knowledge_derivative(cache, knowledge_base)
+        if derived is not None:
+            return derived
+        
+        derived = builder(knowledge_base)
+        cls._register_knowledge_derivative(cache, knowledge_base, derived)
+        return derived
+
+    @staticmethod
+    def _cached_knowledge_derivative(cache: Dict, knowledge_base):
+        """返回已缓存的派生数据，不存在时返回 None"""
+        cached = cache.get(id(knowledge_base) if knowledge_base else None)
+        if cached is not None and cached[0] is (knowledge_base or None):
+            return cached[1]
+        return None
+
+    @classmethod
+    def _register_knowledge_derivative(cls, cache: Dict, knowledge_base, derived):
+        """登记知识库对象的派生数据"""
+        if len(cache) >= cls.MAX_COMPILED_INDEX_CACHE:
+            cache.clear()
+        # 同时保存知识库对象的引用，防止 id 被复用导致误命中
+        cache[id(knowledge_base) if knowledge_base else None] = (knowledge_base or None, derived)
+
+    @classmethod
+    def _build_theme_automaton(cls, knowledge_base: Dict = None) -> TagAutomaton:
+        """以知识库标签和非拉丁字母别名构建提取自动机"""
+        patterns = {}
+        for tag, category in cls.get_compiled_tag_index(knowledge_base).items():
+            if category in cls.THEME_EXCLUDED_CATEGORIES:
+                continue
+            if len(tag) >= cls.THEME_MIN_PATTERN_LENGTH and any(ch.isalpha() for ch in tag):
+                patterns[tag] = tag
+        
+        for alias, tag in (getattr(knowledge_base, 'aliases', None) or {}).items():
+            if not alias.isascii() and len(alias) >= cls.THEME_MIN_ALIAS_LENGTH:
+                patterns.setdefault(alias, tag)
+        
+        # 超大知识库只保留使用次数最高的模式，控制自动机的内存占用
+        if len(patterns) > cls.THEME_MAX_PATTERNS:
+            tag_counts = getattr(knowledge_base, 'tag_counts', None) or {}
+            ranked = sorted(patterns, key=lambda pattern: tag_counts.get(patterns[pattern], 0), reverse=True)
+            patterns = {pattern: patterns[pattern] for pattern in ranked[:cls.THEME_MAX_PATTERNS]}
+        
+        return TagAutomaton(patterns)
+
+    @classmethod
+    def _build_fuzzy_index(cls, knowledge_base: Dict = None) -> TagFuzzyIndex:
+        """以知识库标签在内存中构建纠错索引（首次使用纠错时才构建）"""
+        terms = set()
+        for tags in (knowledge_base or cls._init_tag_database()).values():
+            terms.update(tags)
+        terms = sorted(terms) if len(terms) <= TagFuzzyIndex.MAX_TERMS else []
+        tag_counts = getattr(knowledge_base, 'tag_counts', None) or {}
+        return TagFuzzyIndex.build(terms, [tag_counts.get(term, 0) for term in terms])
+
+    def suggest_tag_correction(self, tag: str, knowledge_base: Dict) -> str:
+        """为拼写错误的标签给出最接近的已知标签，无法纠正时返回 None"""
+        suggestion = self.get_fuzzy_index(knowledge_base).suggest(self.clean_tag(tag))
+        return suggestion[0] if suggestion else None
+
+    def correct_tags_with_knowledge_base(self, tags: str, knowledge_base: Dict,
+                                         custom_tags: set = frozenset()) -> Tuple[str, List[Tuple[str, str]]]:
+        """纠正标签字符串中的拼写错误，返回 (纠正后的标签字符串, [(原标签, 纠正后标签)])
+        
+        已知标签、别名、自定义标签以及带权重/前缀等特殊写法的标签保持原样。
+        """
         tag_list = [tag.strip() for tag in tags.split(',') if tag.strip()]
+        tag_index = self.get_compiled_tag_index(knowledge_base)
+        aliases = getattr(knowledge_base, 'aliases', None) or {}
         
-        classified = {
-            "special": [],
-            "characters": [],
-            "copyrights": [],
-            "artists": [],
-            "general": [],
-            "quality": [],
-            "meta": [],
-            "rating": []
-        }
+        corrections = []
+        corrected_tags = []
+        for tag in tag_list:
+            key = self.clean_tag(tag)
+            if (tag.lower() in tag_index or key in tag_index or key in aliases or key in custom_tags
+                    or not self.FUZZY_CORRECTABLE_PATTERN.match(key)):
+                corrected_tags.append(tag)
+                continue
+            
+            suggestion = self.suggest_tag_correction(key, knowledge_base)
+            if suggestion:
+                corrections.append((tag, suggestion))
+                tag = suggestion
+            corrected_tags.append(tag)
+        
+        if not corrections:
+            return tags, corrections
+        return ", ".join(corrected_tags), corrections
+
+    def extract_tags_from_theme(self, drawing_theme: str, knowledge_base: Dict) -> Tuple[List[str], bool]:
+        """从绘图主题自由文本中提取已知标签，返回 (标签列表, 是否还有未识别的文字)
+        
+        自动机在首次使用时于后台构建（大型知识库需要约1秒），构建完成前按分隔符切分主题、
+        逐段查找编译索引和别名，只识别整段就是已知标签的写法。
+        """
+        if not drawing_theme.strip():
+            return [], False
+        automaton = self.get_theme_automaton(knowledge_base, wait=False)
+        if automaton is None:
+            return self._scan_theme_segments(drawing_theme, knowledge_base)
+        return automaton.extract(drawing_theme)
+    
+    def _scan_theme_segments(self, drawing_theme: str, knowledge_base: Dict) -> Tuple[List[str], bool]:
+        """不依赖自动机的主题提取：每个分隔开的片段整体查找（规则与自动机的模式一致）"""
+        tag_index = self.get_compiled_tag_index(knowledge_base)
+        aliases = getattr(knowledge_base, 'aliases', None) or {}
+        tags = []
+        has_residual = False
+        for segment in self.THEME_SEGMENT_PATTERN.split(drawing_theme):
+            key = self.clean_tag(segment)
+            if not key:
+                continue
+            category = tag_index.get(key)
+            if (category is not None and category not in self.THEME_EXCLUDED_CATEGORIES
+                    and len(key) >= self.THEME_MIN_PATTERN_LENGTH and any(ch.isalpha() for ch in key)):
+                tag = key
+            elif not key.isascii() and len(key) >= self.THEME_MIN_ALIAS_LENGTH:
+                tag = aliases.get(key)
+            else:
+                tag = None
+            if tag is None:
+                has_residual = True
+            elif tag not in tags:
+                tags.append(tag)
+        return tags, has_residual
+
+    @classmethod
+    def _compile_tag_index(cls, knowledge_base: Dict = None) -> Dict[str, str]:
+        """将内置数据库与外部知识库合并，编译为 tag → 类别 的单一映射
         
-        # 合并知识库和内置数据库（外部知识库优先级更高）
-        merged_database = {}
+        合并规则与原先逐次合并的逻辑一致：
+        1. 内置数据库的标签保留在各自类别中
+        2. 外部知识库按 KNOWLEDGE_PRIORITY_ORDER 合并，同一标签只归入第一个类别
+        3. 标签同时属于多个类别时，按 KNOWLEDGE_LOOKUP_ORDER 中先出现的类别为准
+        mmap 模式的知识库编译为直接查询快照的 MappedTagIndex，结果相同。
+        """
+        if isinstance(knowledge_base, MappedTagKnowledgeBase):
+            return cls._compile_mapped_tag_index(knowledge_base)
         
-        # 首先加载内置数据库
-        for category, tags in self.tag_database.items():
-            merged_database[category] = set(tags) if not isinstance(tags, set) else tags.copy()
+        merged_database = {category: set() for category in cls.KNOWLEDGE_LOOKUP_ORDER}
+        
+        for category, tags in cls._init_tag_database().items():
+            if category in merged_database:
+                merged_database[category].update(tags)
         
-        # 然后合并外部知识库，并处理重复标签（按优先级顺序处理）
         if knowledge_base:
-            # 按优先级顺序处理类别，确保重要类别的标签不被覆盖
-            priority_order = ['special', 'quality', 'rating', 'meta', 'characters', 'copyrights', 'artists', 'general']
-            
-            # 收集所有已分类的标签，避免重复
             classified_tags = set()
-            
-            for category in priority_order:
-                if category in knowledge_base:
-                    external_tags = knowledge_base[category]
-                    
-                    if category not in merged_database:
-                        merged_database[category] = set()
-                    
-                    # 确保是set类型
-                    if not isinstance(merged_database[category], set):
-                        merged_database[category] = set(merged_database[category])
-                    if not isinstance(external_tags, set):
-                        external_tags = set(external_tags)
-                    
-                    # 只添加尚未被分类的标签
-                    new_tags = external_tags - classified_tags
-                    merged_database[category].update(new_tags)
-                    classified_tags.update(new_tags)
-            
-            # 处理其他未按优先级处理的类别
-            for category, external_tags in knowledge_base.items():
-                if category not in priority_order:
-                    if category not in merged_database:
-                        merged_database[category] = set()
-                    
-                    if not isinstance(external_tags, set):
-                        external_tags = set(external_tags)
-                    
-                    new_tags = external_tags - classified_tags
-                    merged_database[category].update(new_tags)
-                    classified_tags.update(new_tags)
+            for category in cls.KNOWLEDGE_PRIORITY_ORDER:
+                external_tags = knowledge_base.get(category)
+                if not external_tags:
+                    continue
+                new_tags = set(external_tags) - classified_tags
+                merged_database[category].update(new_tags)
+                classified_tags.update(new_tags)
+        
+        # 逆序写入，使查找顺序中靠前的类别覆盖靠后的类别
+        tag_index = {}
+        for category in reversed(cls.KNOWLEDGE_LOOKUP_ORDER):
+            tag_index.update(dict.fromkeys(merged_database[category], category))
+        
+        return tag_index
+
+    @classmethod
+    def _compile_mapped_tag_index(cls, knowledge_base: MappedTagKnowledgeBase) -> MappedTagIndex:
+        """为 mmap 模式的知识库构建编译索引（只为内置数据库的标签建立字典）"""
+        builtin_tags = set()
+        for tags in cls._init_tag_database().values():
+            builtin_tags.update(tags)
+        builtin_index = {tag: cls._index_category(tag, knowledge_base) for tag in builtin_tags}
+        
+        # 不在内置数据库中的标签，只会被合并到按优先级顺序第一个包含它的类别
+        categories = knowledge_base.snapshot.header["categories"]
+        mask_categories = []
+        for mask in range(256):
+            present = {category for bit, category in enumerate(categories) if mask >> bit & 1}
+            mask_categories.append(next((category for category in cls.KNOWLEDGE_PRIORITY_ORDER
+                                         if category in present), None))
+        
+        tag_index = MappedTagIndex(knowledge_base, builtin_index, mask_categories)
+        # 布隆过滤器需要对全部标签计算哈希，在后台线程中构建，完成前直接二分查找
+        threading.Thread(target=tag_index.build_bloom_filter, args=(knowledge_base.snapshot.header["tag_count"],),
+                         name="TagBloomFilterBuild", daemon=True).start()
+        return tag_index
+
+    def classify_single_tag_with_index(self, tag: str, tag_index: Dict[str, str], 
+                                       custom_chars: set, custom_artists: set, custom_copyrights: set,
+                                       lookup_stats: Dict[str, int] = None) -> str:
+        """使用编译索引分类单个标签（与 classify_single_tag_with_knowledge 的优先级完全一致）
         
-        # 确保所有未分类的标签都有默认类别
-        for category in ["special", "characters", "copyrights", "artists", "general", "quality", "meta", "rating"]:
-            if category not in merged_database:
-                merged_database[category] = set()
+        提供 lookup_stats 时记录本次查找是否命中编译索引。
+        """
+        tag_lower = tag.lower().strip()
+        if lookup_stats is None:
+            category = tag_index.get(tag_lower)
+        else:
+            if isinstance(tag_index, MappedTagIndex):
+                category = tag_index.lookup(tag_lower, lookup_stats)
+            else:
+                category = tag_index.get(tag_lower)
+            lookup_stats["hits" if category is not None else "misses"] += 1
         
-        for tag in tag_list:
-            category = self.classify_single_tag_with_knowledge(tag, merged_database, custom_chars, custom_artists, custom_copyrights)
-            classified[category].append(tag)
+        # 1. special类别（最高优先级）
+        if category == "special":
+            return category
         
-        return classified
+        # 2. 自定义标签
+        if tag in custom_chars:
+            return "characters"
+        if tag in custom_artists:
+            return "artists"
+        if tag in custom_copyrights:
+            return "copyrights"
+        
+        # 3. quality和rating
+        if category == "quality" or category == "rating":
+            return category
+        
+        # 4. 非角色模式，防止常见标签被误分类为角色
+        if self.non_character_rules.match(tag_lower):
+            return "general"
+        
+        # 5-6. general、characters、copyrights
+        if category == "general" or category == "characters" or category == "copyrights":
+            return category
+        
+        # 7. 版权关键词
+        if tag_lower in self._COPYRIGHT_KEYWORDS:
+            return "copyrights"
+        
+        # 8. artists和meta
+        if category is not None:
+            return category
+        
+        # 9. 基于模式匹配（最后的fallback）
+        category = self.shape_rules.match(tag)
+        if category is not None:
+            return category
+        
+        # 10. 默认返回general
+        return "general"
 
     def classify_single_tag_with_knowledge(self, tag: str, knowledge_base: Dict, 
                                          custom_chars: set, custom_artists: set, custom_copyrights: set) -> str:
@@ -790,9 +2354,8 @@ class AdvancedPromptProcessor:
                 return priority_category
         
         # 4. 检查非角色模式，防止常见标签被误分类为角色
-        for pattern in self.non_character_patterns:
-            if pattern.match(tag_lower):
-                return "general"
+        if self.non_character_rules.match(tag_lower):
+            return "general"
         
         # 5. 检查general类别（最大的类别，但在模式匹配之前检查）
         if 'general' in knowledge_base and tag_lower in knowledge_base['general']:
@@ -817,13 +2380,9 @@ class AdvancedPromptProcessor:
             return "meta"
         
         # 9. 基于模式匹配（最后的fallback）
-        for pattern in self.character_patterns:
-            if pattern.match(tag):
-                return "characters"
-        
-        for pattern in self.artist_patterns:
-            if pattern.match(tag):
-                return "artists"
+        category = self.shape_rules.match(tag)
+        if category is not None:
+            return category
         
         # 10. 默认返回general
         return "general"
@@ -1617,7 +3176,9 @@ class AdvancedPromptProcessor:
                       classification_mode: str = "local_knowledge", 
                       custom_characters: str = "", custom_artists: str = "", custom_copyrights: str = "", 
                       enable_symbol_enhancement: bool = True,
-                      proxy_http: str = "", proxy_https: str = "") -> Tuple[str, str, str, Dict, str]:
+                      proxy_http: str = "", proxy_https: str = "",
+                      extract_theme_tags: bool = False,
+                      fuzzy_tag_correction: bool = False) -> Tuple[str, str, str, Dict, str]:
         """主处理函数"""
         
         log_entries = []
@@ -1636,10 +3197,16 @@ class AdvancedPromptProcessor:
         if processed_tags != danbooru_tags:
             log_entries.append("数字替换完成")
         
+        # 本地分类本身需要知识库，提前加载以便同时解析自定义标签中的别名
+        knowledge_base = None
+        use_llm_classification = classification_mode == "llm_classification" and api_key
+        if processed_tags.strip() and not use_llm_classification:
+            knowledge_base = self.load_knowledge_base_from_folder(self.KNOWLEDGE_BASE_PATH)
+        
         # 步骤2: 解析自定义标签（直接添加到输出的标签）
-        custom_chars_list = self.parse_custom_tags(custom_characters)
-        custom_artists_list = self.parse_custom_tags(custom_artists)
-        custom_copyrights_list = self.parse_custom_tags(custom_copyrights)
+        custom_chars_list = self.parse_custom_tags(custom_characters, knowledge_base)
+        custom_artists_list = self.parse_custom_tags(custom_artists, knowledge_base)
+        custom_copyrights_list = self.parse_custom_tags(custom_copyrights, knowledge_base)
         log_entries.append(f"自定义标签解析完成 - 角色:{len(custom_chars_list)}, 画师:{len(custom_artists_list)}, 版权:{len(custom_copyrights_list)}")
         
         # 保留空集合用于分类时的查找
@@ -1650,32 +3217,70 @@ class AdvancedPromptProcessor:
         # 步骤3: 分类标签（选择分类模式）
         classified_tags = {}
         if processed_tags.strip():
-            if classification_mode == "llm_classification" and api_key:
+            if use_llm_classification:
                 classified_tags = self.classify_tags_with_llm(processed_tags, api_url, api_key, model_name, proxy_http, proxy_https)
                 log_entries.append(f"LLM标签分类完成 - 总计:{sum(len(tags) for tags in classified_tags.values())}个标签")
             else:
-                # 使用配置的知识库路径
-                knowledge_base = self.load_knowledge_base_from_folder(self.KNOWLEDGE_BASE_PATH)
                 if knowledge_base:
                     total_tags = sum(len(tags) for tags in knowledge_base.values() if tags)
                     log_entries.append(f"加载Tag knowledge成功 - {len(knowledge_base)} 个类别，{total_tags} 个标签")
                 else:
                     log_entries.append("Tag knowledge为空，使用内置知识库进行分类")
                 
+                if fuzzy_tag_correction:
+                    processed_tags, corrections = self.correct_tags_with_knowledge_base(
+                        processed_tags, knowledge_base, custom_chars_set | custom_artists_set | custom_copyrights_set
+                    )
+                    if corrections:
+                        log_entries.append("标签拼写纠正: " + ", ".join(f"{old} → {new}" for old, new in corrections))
+                
+                lookup_stats = {}
                 classified_tags = self.classify_tags_with_knowledge_base(
-                    processed_tags, knowledge_base, custom_chars_set, custom_artists_set, custom_copyrights_set
+                    processed_tags, knowledge_base, custom_chars_set, custom_artists_set, custom_copyrights_set,
+                    lookup_stats
                 )
                 log_entries.append(f"本地知识库分类完成 - 总计:{sum(len(tags) for tags in classified_tags.values())}个标签")
+                lookup_summary = f"知识库查找 - 命中:{lookup_stats['hits']}, 未命中:{lookup_stats['misses']}"
+                if isinstance(knowledge_base, MappedTagKnowledgeBase):
+                    lookup_summary += (f", 布隆过滤器拦截:{lookup_stats['bloom_rejections']}"
+                                       f", 误判:{lookup_stats['bloom_false_positives']}")
+                log_entries.append(lookup_summary)
         else:
             # 初始化空分类
             classified_tags = {category: [] for category in ["special", "characters", "copyrights", "artists", "general", "quality", "meta", "rating"]}
             log_entries.append("无标签输入，跳过分类")
         
+        # 步骤3.5: 从绘图主题中提取已知标签（本地多模式匹配）
+        llm_theme = drawing_theme
+        if extract_theme_tags and drawing_theme.strip():
+            if knowledge_base is None:
+                knowledge_base = self.load_knowledge_base_from_folder(self.KNOWLEDGE_BASE_PATH)
+            theme_tags, has_residual = self.extract_tags_from_theme(drawing_theme, knowledge_base)
+            if theme_tags:
+                theme_classified = self.classify_tags_with_knowledge_base(
+                    ", ".join(theme_tags), knowledge_base, custom_chars_set, custom_artists_set, custom_copyrights_set
+                )
+                existing_tags = {tag for tags in classified_tags.values() for tag in tags}
+                added_count = 0
+                for category, tags in theme_classified.items():
+                    for tag in tags:
+                        if tag not in existing_tags:
+                            classified_tags.setdefault(category, []).append(tag)
+                            existing_tags.add(tag)
+                            added_count += 1
+                log_entries.append(f"绘图主题提取到 {len(theme_tags)} 个已知标签，新增 {added_count} 个到分类结果")
+                
+                if not has_residual:
+                    # 主题完全由已知标签组成：作为标签交给LLM，不再单独发送主题原文
+                    processed_tags = ", ".join(tag for tag in [processed_tags.strip()] + theme_tags if tag)
+                    llm_theme = ""
+                    log_entries.append("绘图主题完全由已知标签组成，按标签处理")
+        
         # 步骤4: LLM增强
         enhanced_description = ""
         if api_key:
             log_entries.append(f"使用模型: {model_name}")
-            enhanced_description = self.enhance_with_llm(processed_tags, drawing_theme, api_url, api_key, model_name, proxy_http, proxy_https)
+            enhanced_description = self.enhance_with_llm(processed_tags, llm_theme, api_url, api_key, model_name, proxy_http, proxy_https)
             if enhanced_description and not enhanced_description.startswith("API调用失败"):
                 log_entries.append("LLM增强完成")
             else:
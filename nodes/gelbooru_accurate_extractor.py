@@ -4,12 +4,21 @@ Gelbooru准确标签提取器 - 使用Gelbooru Tag API获取准确的标签分
 import os
 import re
 import json
+import codecs
+import hashlib
 import requests
 import random
+import sqlite3
 import numpy as np
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 import time
+import threading
+import urllib.parse
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from itertools import count as count_from, zip_longest
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # 跨平台winreg导入
 try:
@@ -50,17 +59,16 @@ def get_system_proxy():
     return None
 
 
-def make_robust_request(url, timeout=30, max_retries=3):
-    """创建具有代理支持和重试机制的网络请求"""
-    session = requests.Session()
-    
-    # 获取并应用系统代理
-    system_proxies = get_system_proxy()
-    if system_proxies:
-        session.proxies.update(system_proxies)
-        print(f"🌐 Gelbooru使用代理: {system_proxies}")
-    
-    # 配置重试策略
+# 长期复用的 HTTP 会话池：按 (代理配置, 重试次数) 各保留一个 Session，
+# 连续的帖子查询和标签批次复用已建立的 TCP/TLS 连接（keep-alive）
+SESSION_POOL_CONNECTIONS = 8
+SESSION_POOL_MAXSIZE = 16
+_SESSION_POOL = {}
+_SESSION_POOL_LOCK = threading.Lock()
+
+
+def _build_retry_strategy(max_retries):
+    """配置重试策略"""
     try:
         # 新版本urllib3使用allowed_methods
         retry_strategy = Retry(
@@ -77,62 +85,925 @@ def make_robust_request(url, timeout=30, max_retries=3):
             method_whitelist=["HEAD", "GET", "OPTIONS"],
             backoff_factor=1
         )
+    return retry_strategy
+
+
+def get_pooled_session(proxies, max_retries=3):
+    """返回指定代理配置共享的 Session（线程安全；proxies 为 None 表示直连）
     
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
+    Session 创建后不再修改（代理、适配器不变），请求级参数（verify、timeout）在每次调用时传入，
+    因此可以在多个线程中同时使用。
+    """
+    key = (tuple(sorted((proxies or {}).items())), max_retries)
+    with _SESSION_POOL_LOCK:
+        session = _SESSION_POOL.get(key)
+        if session is None:
+            session = requests.Session()
+            if proxies:
+                session.proxies.update(proxies)
+                print(f"🌐 Gelbooru使用代理: {proxies}")
+            adapter = HTTPAdapter(
+                pool_connections=SESSION_POOL_CONNECTIONS,
+                pool_maxsize=SESSION_POOL_MAXSIZE,
+                # max_retries 为0时不配置重试策略，5xx/429 响应直接返回给调用方
+                max_retries=_build_retry_strategy(max_retries) if max_retries else 0,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSION_POOL[key] = session
+        return session
+
+
+def get_session_pool_stats():
+    """连接池统计：会话数、发出的请求数、新建的连接数以及复用连接的请求数"""
+    stats = {'sessions': 0, 'requests': 0, 'connections': 0, 'reused': 0}
+    with _SESSION_POOL_LOCK:
+        sessions = list(_SESSION_POOL.values())
+    stats['sessions'] = len(sessions)
+    adapters = {id(adapter): adapter for session in sessions for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pool_manager = getattr(adapter, 'poolmanager', None)
+        if pool_manager is None:
+            continue
+        for pool_key in list(pool_manager.pools.keys()):
+            pool = pool_manager.pools.get(pool_key)
+            if pool is None:
+                continue
+            stats['requests'] += getattr(pool, 'num_requests', 0)
+            stats['connections'] += getattr(pool, 'num_connections', 0)
+    stats['reused'] = max(0, stats['requests'] - stats['connections'])
+    return stats
+
+
+# 连接方式回退：按优先顺序逐个尝试（代理、直连），只有连接阶段失败（连接错误或连接超时）时才换下一种，
+# 请求一旦发出就不会因为响应慢而重复发送；成功的方式按主机记住，下次优先使用。
+# 请求使用不带重试的会话，连接超时与读取超时分开设置；所有方式都失败时整轮重试（指数退避，受总时限约束）
+CONNECT_TIMEOUT_SECONDS = 5.0
+REQUEST_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+REQUEST_BACKOFF_FACTOR = 1.0
+_PREFERRED_VARIANTS = {}
+
+
+def _connection_variants(system_proxies):
+    """可用的连接方式：(名称, 代理)。不验证SSL（通常更稳定），同一路线不再分验证/不验证两种"""
+    variants = []
+    if system_proxies:
+        variants.append(("代理", system_proxies))
+    # 直连时显式关闭代理，否则 requests 仍会使用环境变量中的代理
+    variants.append(("直连", {"http": None, "https": None}))
+    return variants
+
+
+def get_preferred_connection_variants():
+    """各主机上一次成功的连接方式"""
+    return dict(_PREFERRED_VARIANTS)
+
+
+def make_robust_request(url, timeout=30, max_retries=3, deadline=None, stream=False):
+    """创建具有代理支持和重试机制的网络请求（使用共享的连接池会话）
     
-    # 尝试多种连接方式
-    attempts = [
-        {'verify': False, 'timeout': timeout},          # 先尝试无SSL验证（通常更稳定）
-        {'verify': True, 'timeout': timeout},           # 再尝试SSL验证
-        {'verify': False, 'timeout': timeout * 2},      # 增加超时时间再试
-    ]
+    timeout 为单次请求的读取超时，连接超时为 CONNECT_TIMEOUT_SECONDS；deadline 为整个请求
+    （包括所有连接方式和重试）的总时限（秒），默认 timeout * 2，超过时限立即抛出 ConnectTimeout。
+    每一轮至多有一个请求真正发到服务器；连接失败或 429/5xx 时整轮重试，最多 max_retries 次。
+    stream=True 时只等待响应头，响应体由调用方逐块读取。
+    """
+    deadline_at = time.monotonic() + (deadline if deadline is not None else timeout * 2)
     
+    # 获取系统代理，按上次成功的方式调整顺序
+    system_proxies = get_system_proxy()
+    variants = _connection_variants(system_proxies)
+    host = urllib.parse.urlsplit(url).netloc
+    preferred = _PREFERRED_VARIANTS.get(host)
+    variants.sort(key=lambda variant: variant[0] != preferred)
+    
+    print(f"🌐 Gelbooru连接 {url[:50]}...")
     last_error = None
+    for attempt in range(max_retries + 1):
+        response, last_error, retryable = _try_connection_variants(url, variants, host, timeout, deadline_at, stream)
+        if response is not None:
+            return response
+        if not retryable or attempt == max_retries:
+            break
+        backoff = REQUEST_BACKOFF_FACTOR * (2 ** attempt)
+        if time.monotonic() + backoff >= deadline_at:
+            break
+        print(f"🔄 请求失败，{backoff:.0f}秒后重试 ({attempt + 1}/{max_retries})")
+        time.sleep(backoff)
+    
+    # 所有尝试都失败
+    print(f"❌ Gelbooru所有连接尝试都失败: {last_error}")
+    raise requests.exceptions.ConnectTimeout(f"无法连接到 {url}")
+
+
+def _try_connection_variants(url, variants, host, timeout, deadline_at, stream):
+    """按顺序尝试各连接方式，返回 (成功的响应或 None, 最后的错误, 是否值得重试)
     
-    for i, attempt in enumerate(attempts, 1):
+    只有连接阶段的失败会换下一种方式；请求已发出后的失败（读取超时、HTTP 错误）直接结束本轮，
+    避免同一请求被重复发送到服务器。
+    """
+    last_error = None
+    for name, proxies in variants:
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            return None, last_error or requests.exceptions.ConnectTimeout(f"超过总时限 ({url[:50]})"), False
+        session = get_pooled_session(None, 0)
         try:
-            print(f"🌐 Gelbooru尝试 {i}/{len(attempts)}: 连接 {url[:50]}...")
-            response = session.get(url, **attempt)
-            
-            if response.status_code == 200:
-                print(f"✅ Gelbooru连接成功 (尝试 {i})")
-                return response
-            else:
-                print(f"⚠️  HTTP {response.status_code}, 继续尝试...")
-                
+            response = session.get(url, proxies=proxies, verify=False, stream=stream,
+                                   timeout=(min(CONNECT_TIMEOUT_SECONDS, remaining), min(timeout, remaining)))
         except requests.exceptions.ProxyError as e:
-            print(f"🔧 代理错误 (尝试 {i}): {e}")
-            # 代理错误时，清除代理设置尝试直连
-            session.proxies.clear()
+            print(f"🔧 代理错误 ({name}): {e}")
             last_error = e
             continue
-            
         except requests.exceptions.ConnectTimeout as e:
-            print(f"⏰ 连接超时 (尝试 {i}): {e}")
+            print(f"⏰ 连接超时 ({name}): {e}")
             last_error = e
             continue
-            
-        except Exception as e:
-            print(f"❌ 连接失败 (尝试 {i}): {e}")
+        except requests.exceptions.ConnectionError as e:
+            print(f"❌ 连接失败 ({name}): {e}")
             last_error = e
             continue
+        except requests.exceptions.RequestException as e:
+            # 请求已发出（如读取超时），换连接方式会重复发送同一请求，交给整轮重试处理
+            print(f"❌ 请求失败 ({name}): {e}")
+            return None, e, True
+        
+        if response.status_code == 200:
+            _PREFERRED_VARIANTS[host] = name
+            print(f"✅ Gelbooru连接成功 ({name})")
+            return response, None, False
+        print(f"⚠️  HTTP {response.status_code} ({name})")
+        response.close()
+        error = requests.exceptions.HTTPError(f"HTTP {response.status_code}", response=response)
+        return None, error, response.status_code in REQUEST_RETRY_STATUSES
     
-    # 所有尝试都失败
-    print(f"❌ Gelbooru所有连接尝试都失败: {last_error}")
-    raise requests.exceptions.ConnectTimeout(f"无法连接到 {url}")
+    # 所有方式都在连接阶段失败
+    return None, last_error, True
+
+
+def iter_json_array(chunks, key=None):
+    """从分块到达的 JSON 文本中逐个解析数组元素（生成器）
+    
+    key 为 None 时响应体本身是数组；否则解析顶层对象中 key 对应的数组（找不到时不产生任何元素）。
+    已解析的文本会被丢弃，缓冲区只保留当前未完成的元素，内存占用与响应大小无关。
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    start_pattern = re.compile(r'^\s*\[') if key is None else re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    chunks = iter(chunks)
+    buffer = ''
+    exhausted = False
+    
+    def read_more():
+        nonlocal buffer, exhausted
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer += text_decoder.decode(b'', final=True)
+        else:
+            buffer += text_decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+    
+    # 1. 定位数组开头
+    while True:
+        match = start_pattern.search(buffer)
+        if match:
+            position = match.end()
+            break
+        if exhausted:
+            return
+        if key is not None and len(buffer) > 4096:
+            # 只保留可能跨块的键名前缀
+            buffer = buffer[-(len(key) + 64):]
+        read_more()
+    
+    # 2. 逐个解析元素
+    while True:
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) or exhausted:
+                break
+            buffer = ''
+            position = 0
+            read_more()
+        if position >= len(buffer) or buffer[position] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if exhausted:
+                raise
+            buffer = buffer[position:]
+            position = 0
+            read_more()
+            continue
+        yield item
+        position = end
+
+
+class TagTypeCache:
+    """Gelbooru 标签类型的持久化缓存（SQLite）
+    
+    标签类型几乎不会变化，查询过的类型按 (站点, 标签) 保存，超过 TTL 后视为过期重新查询。
+    每次操作使用独立连接，可在多个线程中同时使用。
+    """
+    
+    # SQLite 单条语句的参数个数上限为 999
+    QUERY_CHUNK_SIZE = 500
+    
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._initialized = False
+    
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tag_types ("
+                "site TEXT NOT NULL, tag TEXT NOT NULL, type INTEGER NOT NULL, updated_at REAL NOT NULL, "
+                "PRIMARY KEY (site, tag))"
+            )
+            connection.commit()
+            self._initialized = True
+        return connection
+    
+    def get_many(self, site, tags):
+        """返回未过期的 标签 → 类型"""
+        if self.ttl_seconds <= 0 or not tags:
+            return {}
+        
+        oldest = time.time() - self.ttl_seconds
+        found = {}
+        try:
+            connection = self._connect()
+            try:
+                for start in range(0, len(tags), self.QUERY_CHUNK_SIZE):
+                    chunk = tags[start:start + self.QUERY_CHUNK_SIZE]
+                    rows = connection.execute(
+                        f"SELECT tag, type FROM tag_types WHERE site = ? AND updated_at >= ? "
+                        f"AND tag IN ({','.join('?' * len(chunk))})",
+                        [site, oldest, *chunk],
+                    )
+                    found.update(rows)
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            print(f"⚠️  标签类型缓存读取失败: {e}")
+        return found
+    
+    def put_many(self, site, tag_types):
+        """写入（或刷新）标签类型"""
+        if self.ttl_seconds <= 0 or not tag_types:
+            return
+        
+        now = time.time()
+        try:
+            connection = self._connect()
+            try:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO tag_types (site, tag, type, updated_at) VALUES (?, ?, ?, ?)",
+                    [(site, tag, tag_type, now) for tag, tag_type in tag_types.items()],
+                )
+                connection.commit()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            print(f"⚠️  标签类型缓存写入失败: {e}")
+
+
+class TokenBucket:
+    """线程安全的令牌桶限速器
+    
+    桶内最多 capacity 个令牌，每秒补充 rate 个；acquire 取一个令牌，没有令牌时阻塞等待。
+    """
+    
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class PostQueryCache:
+    """帖子查询结果的本地缓存（每个查询一个 JSON 文件）
+    
+    缓存键为 (站点, tags 查询串)，不含 API 凭据和数量；超过 TTL 的结果视为过期。
+    读取命中时刷新文件修改时间，写入后按修改时间淘汰最久未用的查询，直到总大小不超过磁盘预算。
+    """
+    
+    def __init__(self, directory, ttl_seconds, max_bytes):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+    
+    def _path(self, site, tags_query):
+        digest = hashlib.sha1(f"{site}\n{tags_query}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+    
+    def get(self, site, tags_query):
+        """返回未过期的帖子列表，未命中时返回 None"""
+        path = self._path(site, tags_query)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('fetched_at', 0) > self.ttl_seconds:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get('posts', [])
+    
+    def put(self, site, tags_query, posts):
+        path = self._path(site, tags_query)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'site': site, 'query': tags_query, 'fetched_at': time.time(), 'posts': posts}, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"⚠️  查询缓存写入失败: {e}")
+            return
+        self._evict(keep=path)
+    
+    def _evict(self, keep):
+        """按最近使用时间淘汰，直到总大小不超过 max_bytes（刚写入的查询不淘汰）"""
+        with self._lock:
+            entries = []
+            try:
+                for entry in os.scandir(self.directory):
+                    if entry.name.endswith('.json'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                return
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+class ImageDownloadCache:
+    """按内容寻址的图片缓存（文件名为图片 md5）
+    
+    文件保存为 <目录>/<md5前两位>/<md5>.<扩展名>；命中时刷新修改时间，
+    evict 按修改时间淘汰最久未用的图片，直到总大小不超过 max_bytes。
+    """
+    
+    MD5_PATTERN = re.compile(r'([0-9a-f]{32})', re.IGNORECASE)
+    TEMP_SUFFIX = ".download"
+    # 超过该时间仍未完成的临时文件视为中断残留（进程被终止等），淘汰时一并清理
+    STALE_DOWNLOAD_SECONDS = 3600
+    
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'downloads': 0, 'bytes': 0}
+        self._lock = threading.Lock()
+    
+    def _path(self, md5, extension):
+        return os.path.join(self.directory, md5[:2], f"{md5}{extension}")
+    
+    def fetch(self, url, md5=None):
+        """返回图片的本地路径（已缓存时不访问网络）
+        
+        下载内容与期望的 md5 不一致时删除临时文件并抛出 ValueError，不写入缓存。
+        """
+        url_path = urllib.parse.urlsplit(url).path
+        extension = os.path.splitext(url_path)[1].lower() or '.bin'
+        if not md5:
+            # Gelbooru 的文件名本身就是 md5
+            match = self.MD5_PATTERN.search(os.path.basename(url_path))
+            md5 = match.group(1) if match else None
+        md5 = md5.lower() if md5 else None
+        
+        if md5:
+            path = self._path(md5, extension)
+            if os.path.exists(path):
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                with self._lock:
+                    self.stats['hits'] += 1
+                return path
+        
+        response = make_robust_request(url, timeout=60, stream=True)
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = os.path.join(self.directory, f".{os.getpid()}.{threading.get_ident()}{self.TEMP_SUFFIX}")
+        hasher = hashlib.md5()
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            
+            actual_md5 = hasher.hexdigest()
+            if md5 and actual_md5 != md5:
+                # 不按实际 md5 保存：之后总是按帖子的 md5 查找，这样的文件永远不会命中
+                raise ValueError(f"图片 md5 不一致（期望 {md5}，实际 {actual_md5}）")
+            path = self._path(actual_md5, extension)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        except BaseException:
+            # 下载中断或写入失败时删除不完整的临时文件
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        finally:
+            response.close()
+        
+        with self._lock:
+            self.stats['downloads'] += 1
+            self.stats['bytes'] += size
+        return path
+    
+    def evict(self, keep=()):
+        """按最近使用时间淘汰，直到总大小不超过 max_bytes（keep 中的路径不淘汰）
+        
+        同时清理超过 STALE_DOWNLOAD_SECONDS 的下载临时文件（其他进程正在写入的较新临时文件保留）。
+        """
+        keep = set(keep)
+        stale_before = time.time() - self.STALE_DOWNLOAD_SECONDS
+        with self._lock:
+            entries = []
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if name.startswith('.'):
+                        if name.endswith(self.TEMP_SUFFIX) and stat.st_mtime < stale_before:
+                            try:
+                                os.remove(path)
+                            except OSError:
+                                pass
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path in keep:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+class LocalPostMirror:
+    """本地 Gelbooru 帖子镜像（JSONL 导出文件，每行一个帖子）
+    
+    倒排索引：标签 → 帖子编号的有序 int32 数组（CSR 格式：postings_offsets + postings），
+    评级以 rating:<值> 伪标签的形式入索引，分数单独保存为数组。帖子本身不载入内存，
+    只记录每行在文件中的字节偏移，抽样后再读取对应的行。
+    索引保存在导出文件旁的 <文件名>.index.npz，文件大小和修改时间不变时直接载入。
+    """
+    
+    INDEX_SUFFIX = ".index.npz"
+    INDEX_VERSION = 1
+    # 缩写评级（Danbooru 导出）对应的 Gelbooru 评级名
+    RATING_ALIASES = {'g': 'general', 's': 'sensitive', 'q': 'questionable', 'e': 'explicit'}
+    SCORE_PATTERN = re.compile(r'^score:(>=|<=|>|<|=)?(-?\d+)$')
+    
+    _MIRRORS = {}
+    _MIRRORS_LOCK = threading.Lock()
+    
+    def __init__(self, path, vocabulary, postings_offsets, postings, line_offsets, scores):
+        self.path = path
+        self.vocabulary = vocabulary
+        self.postings_offsets = postings_offsets
+        self.postings = postings
+        self.line_offsets = line_offsets
+        self.scores = scores
+    
+    def __len__(self):
+        return len(self.line_offsets)
+    
+    @classmethod
+    def open(cls, path):
+        """打开（并缓存）镜像，导出文件变化时重新载入"""
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        fingerprint = (stat.st_size, stat.st_mtime_ns)
+        with cls._MIRRORS_LOCK:
+            cached = cls._MIRRORS.get(path)
+            if cached is not None and cached[0] == fingerprint:
+                return cached[1]
+            mirror = cls._load_index(path, fingerprint)
+            if mirror is None:
+                mirror = cls._build(path)
+                mirror._save_index(fingerprint)
+            cls._MIRRORS[path] = (fingerprint, mirror)
+            return mirror
+    
+    @classmethod
+    def _post_tags(cls, post):
+        """帖子的标签（小写）以及评级伪标签"""
+        tags = post.get('tags', post.get('tag_string', ''))
+        if isinstance(tags, str):
+            tags = set(tags.lower().split())
+        else:
+            tags = {str(tag).lower() for tag in tags}
+        rating = str(post.get('rating') or '').lower()
+        if rating:
+            tags.add(f"rating:{rating}")
+            if rating in cls.RATING_ALIASES:
+                tags.add(f"rating:{cls.RATING_ALIASES[rating]}")
+        return tags
+    
+    @classmethod
+    def _build(cls, path):
+        """扫描导出文件并构建倒排索引"""
+        print(f"🗂️  构建本地镜像索引: {path}")
+        start_time = time.time()
+        # 首次出现的标签自动分配下一个编号
+        vocabulary = defaultdict(count_from().__next__)
+        tag_ids = array('i')
+        tag_counts = array('i')
+        line_offsets = array('q')
+        scores = array('i')
+        
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                line_offset = offset
+                offset += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    post = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(post, dict):
+                    continue
+                post_tags = cls._post_tags(post)
+                tag_ids.extend(map(vocabulary.__getitem__, post_tags))
+                tag_counts.append(len(post_tags))
+                line_offsets.append(line_offset)
+                try:
+                    scores.append(int(post.get('score') or 0))
+                except (TypeError, ValueError):
+                    scores.append(0)
+        
+        tag_ids = np.frombuffer(tag_ids, dtype=np.int32)
+        post_ids = np.repeat(np.arange(len(line_offsets), dtype=np.int32), np.frombuffer(tag_counts, dtype=np.int32))
+        # 稳定排序后，每个标签的帖子编号保持升序
+        order = np.argsort(tag_ids, kind='stable')
+        postings = post_ids[order]
+        postings_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tag_ids, minlength=len(vocabulary)), out=postings_offsets[1:])
+        
+        mirror = cls(path, dict(vocabulary), postings_offsets, postings,
+                     np.frombuffer(line_offsets, dtype=np.int64), np.frombuffer(scores, dtype=np.int32))
+        print(f"✅ 本地镜像索引完成: {len(mirror)} 个帖子, {len(vocabulary)} 个标签, 耗时 {time.time() - start_time:.2f}s")
+        return mirror
+    
+    @classmethod
+    def _load_index(cls, path, fingerprint):
+        index_path = path + cls.INDEX_SUFFIX
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with np.load(index_path) as data:
+                if int(data['version']) != cls.INDEX_VERSION or tuple(data['fingerprint'].tolist()) != fingerprint:
+                    return None
+                terms = data['vocabulary'].tobytes().decode('utf-8')
+                vocabulary = {tag: tag_id for tag_id, tag in enumerate(terms.split('\n'))} if terms else {}
+                mirror = cls(path, vocabulary, data['postings_offsets'], data['postings'],
+                             data['line_offsets'], data['scores'])
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️  本地镜像索引读取失败，将重新构建: {e}")
+            return None
+        print(f"📂 载入本地镜像索引: {len(mirror)} 个帖子, {len(vocabulary)} 个标签")
+        return mirror
+    
+    def _save_index(self, fingerprint):
+        index_path = self.path + self.INDEX_SUFFIX
+        temp_path = f"{index_path}.{os.getpid()}.tmp.npz"
+        vocabulary = np.frombuffer('\n'.join(self.vocabulary).encode('utf-8'), dtype=np.uint8)
+        try:
+            np.savez(temp_path, version=np.array(self.INDEX_VERSION), fingerprint=np.array(fingerprint, dtype=np.int64),
+                     vocabulary=vocabulary, postings_offsets=self.postings_offsets, postings=self.postings,
+                     line_offsets=self.line_offsets, scores=self.scores)
+            os.replace(temp_path, index_path)
+        except OSError as e:
+            print(f"⚠️  本地镜像索引保存失败: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    def _postings_for(self, tag):
+        tag_id = self.vocabulary.get(tag)
+        if tag_id is None:
+            return np.empty(0, dtype=np.int32)
+        return self.postings[self.postings_offsets[tag_id]:self.postings_offsets[tag_id + 1]]
+    
+    @classmethod
+    def parse_query(cls, tags_query):
+        """解析与 API 相同的 tags 查询串，返回 (AND标签, OR组列表, 排除标签, 分数条件列表)
+        
+        支持 a+b、{a ~ b} 或 ( a ~ b )、-tag、rating:x、score:>N；sort: 等其他元标签忽略。
+        """
+        tokens = urllib.parse.unquote(tags_query.replace('+', ' ')).lower().split()
+        required, groups, excluded, score_filters = [], [], [], []
+        group = None
+        for token in tokens:
+            # 只去掉一个分组定界符，标签自身的括号（如 saber_(fate)）保持不变
+            if group is None and (token == '(' or token.startswith('{')):
+                group = []
+                token = token[1:]
+            if group is not None:
+                closing = token == ')' or token.endswith('}')
+                if closing:
+                    token = token[:-1]
+                if token and token != '~':
+                    group.append(token)
+                if closing:
+                    if group:
+                        groups.append(group)
+                    group = None
+                continue
+            if token.startswith('-'):
+                if token[1:]:
+                    excluded.append(token[1:])
+            elif token.startswith('sort:'):
+                continue
+            elif token.startswith('score:'):
+                match = cls.SCORE_PATTERN.match(token)
+                if match:
+                    score_filters.append((match.group(1) or '=', int(match.group(2))))
+            else:
+                required.append(token)
+        if group:
+            groups.append(group)
+        return required, groups, excluded, score_filters
+    
+    def match(self, tags_query):
+        """返回满足查询的帖子编号（升序 int32 数组）"""
+        required, groups, excluded, score_filters = self.parse_query(tags_query)
+        
+        # 每个 OR 组先合并为一个有序数组，再和 AND 标签一起从最短的开始求交集
+        positives = [self._postings_for(tag) for tag in required]
+        for group in groups:
+            if group:
+                positives.append(np.unique(np.concatenate([self._postings_for(tag) for tag in group])))
+        positives.sort(key=len)
+        
+        if positives:
+            candidates = positives[0]
+            for postings in positives[1:]:
+                if not len(candidates):
+                    break
+                candidates = np.intersect1d(candidates, postings, assume_unique=True)
+        else:
+            candidates = np.arange(len(self), dtype=np.int32)
+        
+        if excluded and len(candidates):
+            keep = np.ones(len(self), dtype=bool)
+            for tag in excluded:
+                keep[self._postings_for(tag)] = False
+            candidates = candidates[keep[candidates]]
+        
+        for operator, value in score_filters:
+            scores = self.scores[candidates]
+            if operator == '>':
+                candidates = candidates[scores > value]
+            elif operator == '>=':
+                candidates = candidates[scores >= value]
+            elif operator == '<':
+                candidates = candidates[scores < value]
+            elif operator == '<=':
+                candidates = candidates[scores <= value]
+            else:
+                candidates = candidates[scores == value]
+        return candidates
+    
+    def search(self, tags_query, count, rng=random):
+        """随机抽取至多 count 个匹配的帖子（rng 为抽样使用的随机数生成器，默认为已设置种子的 random）"""
+        candidates = self.match(tags_query)
+        picks = rng.sample(range(len(candidates)), min(count, len(candidates)))
+        posts = []
+        with open(self.path, 'rb') as f:
+            for pick in picks:
+                f.seek(int(self.line_offsets[candidates[pick]]))
+                post = json.loads(f.readline())
+                tags = post.get('tags', post.get('tag_string', ''))
+                post['tags'] = tags if isinstance(tags, str) else ' '.join(tags)
+                posts.append(post)
+        print(f"🗂️  本地镜像匹配 {len(candidates)} 个帖子，抽取 {len(posts)} 个")
+        return posts
+
+
+class PostPrefetcher:
+    """单个固定查询的后台预取缓冲区
+    
+    缓冲区保存已获取并已分类的帖子：(帖子, 标签 → 类别)。take 立即取出缓冲的帖子，
+    剩余数量低于容量一半时在后台线程补充（同一时间最多一个补充线程）。
+    fetch(limit) 返回至多 limit 个 (帖子, 标签 → 类别)。
+    """
+    
+    # 单次补充请求的帖子数上限（Gelbooru API 单页最多100条）
+    MAX_PAGE_SIZE = 100
+    
+    def __init__(self, fetch, capacity):
+        self.fetch = fetch
+        self.capacity = capacity
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._buffer)
+    
+    def take(self, count):
+        """取出至多 count 个缓冲的帖子，并在缓冲区不足时触发后台补充"""
+        with self._lock:
+            entries = [self._buffer.popleft() for _ in range(min(count, len(self._buffer)))]
+            start_refill = not self._refilling and len(self._buffer) < max(1, self.capacity // 2)
+            if start_refill:
+                self._refilling = True
+        if start_refill:
+            threading.Thread(target=self._refill, name="gelbooru-prefetch", daemon=True).start()
+        return entries
+    
+    def _refill(self):
+        try:
+            while True:
+                with self._lock:
+                    missing = self.capacity - len(self._buffer)
+                if missing <= 0:
+                    break
+                entries = self.fetch(min(missing, self.MAX_PAGE_SIZE))
+                with self._lock:
+                    buffered_ids = {self._post_id(post) for post, _ in self._buffer}
+                    new_entries = [entry for entry in entries if self._post_id(entry[0]) not in buffered_ids]
+                    self._buffer.extend(new_entries[:max(0, self.capacity - len(self._buffer))])
+                print(f"📦 预取了 {len(new_entries)} 张图片，缓冲区 {len(self)}/{self.capacity}")
+                # 查询结果不足或全部重复时不再继续请求
+                if len(new_entries) < min(missing, self.MAX_PAGE_SIZE):
+                    break
+        except Exception as e:
+            print(f"⚠️  后台预取失败: {e}")
+        finally:
+            with self._lock:
+                self._refilling = False
+    
+    @staticmethod
+    def _post_id(post):
+        return post.get("id") or post.get("md5") or id(post)
+
+
+class FallbackTagCategorizer:
+    """预编译的备用标签分类器
+    
+    每个类别的子串列表（转义后）和正则列表合并为一个编译好的正则交替式，
+    search 命中当且仅当原先逐条检查中任意一条命中，因此分类结果与逐条匹配完全一致。
+    类别按 CATEGORY_ORDER 的顺序判定，第一个命中的类别胜出。
+    """
+    
+    CATEGORY_ORDER = ('metadata', 'artists', 'characters', 'copyrights')
+    
+    def __init__(self, substrings, regexes):
+        """substrings / regexes: 类别 → 子串列表 / 正则表达式列表"""
+        self._matchers = []
+        for category in self.CATEGORY_ORDER:
+            alternatives = [re.escape(pattern) for pattern in substrings.get(category, ())]
+            # search 模式下开头的 .* 不影响是否命中，去掉后可避免在每个起点重复回溯
+            alternatives += [f"(?:{self._strip_leading_wildcard(pattern)})" for pattern in regexes.get(category, ())]
+            if alternatives:
+                self._matchers.append((category, re.compile("|".join(alternatives)).search))
+    
+    @staticmethod
+    def _strip_leading_wildcard(pattern):
+        """去掉开头的贪婪 .*（不处理 .*? 等带修饰的写法）"""
+        if pattern.startswith('.*') and pattern[2:3] not in ('?', '+', '{'):
+            return pattern[2:]
+        return pattern
+    
+    def categorize(self, tag):
+        """返回单个标签的类别"""
+        tag_lower = tag.lower()
+        for category, search in self._matchers:
+            if search(tag_lower):
+                return category
+        return 'general'
+    
+    def categorize_all(self, tags):
+        """按类别分组（保持输入顺序）"""
+        categorized = {category: [] for category in ('artists', 'characters', 'copyrights', 'general', 'metadata')}
+        # 同一标签只分类一次
+        categories = {}
+        for tag in tags:
+            category = categories.get(tag)
+            if category is None:
+                category = categories[tag] = self.categorize(tag)
+            categorized[category].append(tag)
+        return categorized
 
 
 class GelbooruAccurateExtractor:
     """使用Gelbooru Tag API获取准确标签分类的提取器"""
     
+    # 备用分类的补充正则（预编译，避免每个标签重新构建模式列表）
+    LIKELY_ARTIST_PATTERNS = (
+        r'^[a-z]+_[a-z]+_artist$',  # 明确的画师标签
+        r'^\w+_\(artist\)$',        # 带(artist)标记的
+    )
+    LIKELY_CHARACTER_PATTERNS = (
+        r'.*_\(.*\)$',       # 带括号的角色名
+    )
+    LIKELY_COPYRIGHT_PATTERNS = (
+        r'.*_series$',       # 系列名
+        r'.*_game$',         # 游戏名
+        r'.*_anime$',        # 动画名
+    )
+    _LIKELY_REGEX_CACHE = {}
+    _FALLBACK_CATEGORIZER_CACHE = {}
+    
+    # Tag API 查询结果的持久化缓存（位于插件目录）
+    TAG_CACHE_FILENAME = ".gelbooru_tag_cache.sqlite3"
+    DEFAULT_TAG_CACHE_TTL_HOURS = 720
+    
+    # Tag API 并发查询：names 参数（URL编码后）的长度上限、每批标签数上限（API 单页最多返回100条）、
+    # 并发线程数，以及所有节点共享的令牌桶（每秒请求数 / 突发请求数）
+    TAG_API_MAX_NAMES_LENGTH = 1800
+    TAG_API_MAX_BATCH_TAGS = 100
+    TAG_API_MAX_WORKERS = 4
+    TAG_API_RATE_LIMITER = TokenBucket(rate=5, capacity=4)
+    
+    # 帖子查询缓存：每个查询获取一整页结果，每次运行在本地按随机种子抽样
+    QUERY_CACHE_DIRNAME = ".gelbooru_query_cache"
+    QUERY_CACHE_PAGE_SIZE = 100
+    DEFAULT_QUERY_CACHE_TTL_HOURS = 0
+    DEFAULT_QUERY_CACHE_MAX_MB = 200
+    
+    # 图片下载缓存（按 md5 内容寻址，超过磁盘上限时淘汰最久未用的图片）
+    IMAGE_CACHE_DIRNAME = ".gelbooru_image_cache"
+    IMAGE_DOWNLOAD_WORKERS = 4
+    DEFAULT_IMAGE_CACHE_MAX_MB = 2048
+    
+    # 每个固定查询一个后台预取缓冲区，最多保留 MAX_PREFETCHERS 个（最久未用的先丢弃）；
+    # 预取会额外产生API请求，默认关闭
+    DEFAULT_PREFETCH_BUFFER_SIZE = 0
+    MAX_PREFETCHERS = 8
+    _PREFETCHERS = OrderedDict()
+    _PREFETCHERS_LOCK = threading.Lock()
+    
+    # 分页批量获取：超过一页的数量按页并发请求（共享令牌桶限速），响应体流式解析，
+    # 每个帖子只保留下列字段；分页深度上限为 POSTS_MAX_OFFSET 个帖子（更旧的帖子无法分页取到）。
+    # sort:random 每页独立随机、页与页之间会重叠，分页时改用默认顺序：先查询结果总数，
+    # 在可分页的范围内按已设置种子的随机数随机选页，取 POSTS_BULK_OVERSAMPLE 倍的候选帖子蓄水池抽样
+    POSTS_PAGE_SIZE = {"Gelbooru": 100, "Rule34": 1000}
+    POSTS_MAX_OFFSET = 20000
+    POSTS_BULK_OVERSAMPLE = 2
+    RANDOM_SORT_TOKEN = "sort%3arandom"
+    POSTS_MAX_WORKERS = 4
+    POSTS_API_RATE_LIMITER = TokenBucket(rate=4, capacity=4)
+    BULK_POST_FIELDS = ('id', 'md5', 'tags', 'file_url', 'rating', 'score')
+    
+    # 带 Danbooru 类别代码的本地标签表（相对插件目录）
+    LOCAL_TAG_TABLE = ("Tag knowledge", "danbooru_tags.csv")
+    _LOCAL_TAG_TYPES = None
+    
     @classmethod
     def INPUT_TYPES(cls):
         return {
             "required": {
                 "enable_gelbooru": ("BOOLEAN", {"default": True, "tooltip": "是否启用Gelbooru标签获取"}),
-                "site": (["Gelbooru", "Rule34"], {"default": "Gelbooru"}),
+                "site": (["Gelbooru", "Rule34", "Local", "Federated"], {"default": "Gelbooru"}),
                 "OR_tags": ("STRING", {"default": "", "multiline": True}),
                 "AND_tags": ("STRING", {"default": "", "multiline": True}),
                 "exclude_tag": ("STRING", {"default": "animated,", "multiline": True}),
@@ -140,7 +1011,7 @@ class GelbooruAccurateExtractor:
                 "Questionable": ("BOOLEAN", {"default": True}),
                 "Explicit": ("BOOLEAN", {"default": False}),
                 "score": ("INT", {"default": 10, "min": 0, "max": 1000}),
-                "count": ("INT", {"default": 1, "min": 1, "max": 10}),
+                "count": ("INT", {"default": 1, "min": 1, "max": 5000, "tooltip": "获取的图片数量，超过一页时自动分页并发获取（在最新的20000个匹配帖子中随机选页，更旧的帖子无法分页取到）"}),
                 "random_seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}),
                 "auto_random_seed": ("BOOLEAN", {"default": True, "tooltip": "自动生成9位数随机种子"}),
                 
@@ -172,12 +1043,55 @@ class GelbooruAccurateExtractor:
             "optional": {
                 "user_id": ("STRING", {"default": ""}),
                 "api_key": ("STRING", {"default": ""}),
+                "tag_cache_ttl_hours": ("INT", {
+                    "default": 720, "min": 0, "max": 87600,
+                    "tooltip": "Tag API查询结果在本地缓存的有效期（小时），0表示不使用缓存"
+                }),
+                "prefetch_buffer_size": ("INT", {
+                    "default": 0, "min": 0, "max": 500,
+                    "tooltip": "后台预取并分类的图片数量，相同查询直接从缓冲区取图，0表示不预取（默认）；会额外产生API请求，Local和Federated站点不预取"
+                }),
+                "local_dump_path": ("STRING", {
+                    "default": "",
+                    "tooltip": "site为Local时使用的本地帖子导出文件（JSONL，每行一个帖子）"
+                }),
+                "query_cache_ttl_hours": ("INT", {
+                    "default": 0, "min": 0, "max": 8760,
+                    "tooltip": "查询结果本地缓存的有效期（小时）；启用后每次运行按随机种子从缓存中抽图，结果可复现。0表示不缓存"
+                }),
+                "query_cache_max_mb": ("INT", {
+                    "default": 200, "min": 1, "max": 10240,
+                    "tooltip": "查询缓存的磁盘上限（MB），超出时淘汰最久未用的查询"
+                }),
+                "tag_ranking": (["frequency", "score_weighted", "original"], {
+                    "default": "frequency",
+                    "tooltip": "各类别标签的排序：按出现频次、按帖子分数加权的频次，或按首次出现的顺序"
+                }),
+                "download_images": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "并发下载图片到本地缓存，并在local_image_paths输出本地路径"
+                }),
+                "image_cache_max_mb": ("INT", {
+                    "default": 2048, "min": 1, "max": 102400,
+                    "tooltip": "图片缓存的磁盘上限（MB），超出时淘汰最久未用的图片"
+                }),
+                "federated_sources": ("STRING", {
+                    "default": "Gelbooru\nRule34", "multiline": True,
+                    "tooltip": "site为Federated时同时查询的来源，每行一个：Gelbooru、Rule34、Local（使用local_dump_path）、"
+                               "Local:<JSONL路径>，或Gelbooru兼容的自建镜像API地址（如 https://example.com/index.php）；"
+                               "user_id/api_key只发给Gelbooru，其他来源可写成 来源|user_id|api_key 单独配置凭据"
+                }),
+                "federated_deadline_seconds": ("INT", {
+                    "default": 30, "min": 1, "max": 600,
+                    "tooltip": "Federated模式的总时限（秒），超时未返回的来源被放弃，使用已返回的部分结果"
+                }),
             }
         }
     
     # 按正确顺序返回：Artist-Character-Copyright-General-Metadata
-    RETURN_TYPES = ("STRING", "STRING", "STRING", "STRING", "STRING", "STRING", "STRING", "STRING")
-    RETURN_NAMES = ("combined_tags", "artists", "characters", "copyrights", "general_tags", "metadata", "image_urls", "tag_info")
+    RETURN_TYPES = ("STRING", "STRING", "STRING", "STRING", "STRING", "STRING", "STRING", "STRING", "STRING")
+    RETURN_NAMES = ("combined_tags", "artists", "characters", "copyrights", "general_tags", "metadata", "image_urls", "tag_info",
+                    "local_image_paths")
     FUNCTION = "extract_accurate_tags"
     CATEGORY = "Advanced Prompt Processor/Gelbooru"
     
@@ -219,6 +1133,21 @@ class GelbooruAccurateExtractor:
             'commentary', 'md5:', 'status:', 'approver:', 'uploader:', 'highres',
             'absurdres', 'incredibly_absurdres', 'huge_filesize', 'lowres', 'jpeg_artifacts'
         ]
+        
+        plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.tag_cache = TagTypeCache(
+            os.path.join(plugin_dir, self.TAG_CACHE_FILENAME),
+            self.DEFAULT_TAG_CACHE_TTL_HOURS * 3600
+        )
+        self.query_cache = PostQueryCache(
+            os.path.join(plugin_dir, self.QUERY_CACHE_DIRNAME),
+            self.DEFAULT_QUERY_CACHE_TTL_HOURS * 3600,
+            self.DEFAULT_QUERY_CACHE_MAX_MB * 1024 * 1024
+        )
+        self.image_cache = ImageDownloadCache(
+            os.path.join(plugin_dir, self.IMAGE_CACHE_DIRNAME),
+            self.DEFAULT_IMAGE_CACHE_MAX_MB * 1024 * 1024
+        )
     
     def extract_accurate_tags(self, enable_gelbooru, site, OR_tags, AND_tags, exclude_tag, Safe, Questionable, Explicit, 
                              score, count, random_seed, auto_random_seed,
@@ -226,8 +1155,16 @@ class GelbooruAccurateExtractor:
                              artist_format, character_format, copyright_format, general_format, metadata_format,
                              max_artists, max_characters, max_copyrights, max_general, max_metadata,
                              separator, use_tag_api,
-                             user_id="", api_key=""):
+                             user_id="", api_key="", tag_cache_ttl_hours=DEFAULT_TAG_CACHE_TTL_HOURS,
+                             prefetch_buffer_size=DEFAULT_PREFETCH_BUFFER_SIZE, local_dump_path="",
+                             query_cache_ttl_hours=DEFAULT_QUERY_CACHE_TTL_HOURS,
+                             query_cache_max_mb=DEFAULT_QUERY_CACHE_MAX_MB, tag_ranking="frequency",
+                             download_images=False, image_cache_max_mb=DEFAULT_IMAGE_CACHE_MAX_MB,
+                             federated_sources="Gelbooru\nRule34", federated_deadline_seconds=30):
         """使用Gelbooru Tag API获取准确的标签分类"""
+        self.tag_cache.ttl_seconds = tag_cache_ttl_hours * 3600
+        self.query_cache.ttl_seconds = query_cache_ttl_hours * 3600
+        self.query_cache.max_bytes = query_cache_max_mb * 1024 * 1024
         
         # 检查是否启用Gelbooru
         if not enable_gelbooru:
@@ -246,12 +1183,31 @@ class GelbooruAccurateExtractor:
         else:
             print("使用系统默认随机种子")
         
+        pool_stats_before = get_session_pool_stats()
         try:
-            # 1. 获取图片数据
-            posts_data = self._get_posts_data(
-                site, OR_tags, AND_tags, exclude_tag, Safe, Questionable, Explicit,
-                score, count, user_id, api_key
-            )
+            query = (site, OR_tags, AND_tags, exclude_tag, Safe, Questionable, Explicit,
+                     score, user_id, api_key, use_tag_api, local_dump_path,
+                     federated_sources, federated_deadline_seconds)
+            
+            # 1. 优先从后台预取缓冲区取图（已分类），不足的部分实时获取
+            #    本地镜像和查询缓存按随机种子在本地抽样，不使用预取（保证结果可复现）；
+            #    联合查询每次会请求多个站点，预取会成倍放大请求量，同样不使用
+            buffered_entries = []
+            if (prefetch_buffer_size > 0 and site not in ("Local", "Federated")
+                    and query_cache_ttl_hours <= 0):
+                prefetcher = self._get_prefetcher(query, prefetch_buffer_size)
+                buffered_entries = prefetcher.take(count)
+                if buffered_entries:
+                    print(f"📦 从预取缓冲区取得 {len(buffered_entries)} 张图片（剩余 {len(prefetcher)}）")
+            
+            live_posts = []
+            if len(buffered_entries) < count:
+                live_posts = self._get_posts_data(
+                    site, OR_tags, AND_tags, exclude_tag, Safe, Questionable, Explicit,
+                    score, count - len(buffered_entries), user_id, api_key, local_dump_path,
+                    federated_sources, federated_deadline_seconds
+                )
+            posts_data = [post for post, _ in buffered_entries] + live_posts
             
             if not posts_data:
                 return self._empty_result("未找到匹配的图片")
@@ -262,10 +1218,28 @@ class GelbooruAccurateExtractor:
             if not all_tags:
                 return self._empty_result("图片中没有找到标签")
             
-            # 3. 使用Tag API获取准确分类
-            categorized_tags = self._categorize_tags_with_api(
-                all_tags, site, user_id, api_key, use_tag_api
-            )
+            # 3. 使用Tag API获取准确分类（缓冲区中的帖子已分类）
+            if not buffered_entries:
+                categorized_tags = self._categorize_tags_with_api(
+                    all_tags, site, user_id, api_key, use_tag_api
+                )
+            else:
+                tag_categories = {}
+                for _, post_categories in buffered_entries:
+                    tag_categories.update(post_categories)
+                live_tags = [tag for tag in self._extract_tags_from_posts(live_posts) if tag not in tag_categories]
+                if live_tags:
+                    live_categorized = self._categorize_tags_with_api(live_tags, site, user_id, api_key, use_tag_api)
+                    for category, tag_list in live_categorized.items():
+                        tag_categories.update(dict.fromkeys(tag_list, category))
+                categorized_tags = self._group_tags_by_category(all_tags, tag_categories)
+            
+            # 按所有图片中的出现频次对各类别排序（频次相同时保持首次出现的顺序）
+            tag_frequencies = {}
+            if tag_ranking != "original":
+                tag_frequencies = self._aggregate_tag_frequencies(posts_data, weight_by_score=tag_ranking == "score_weighted")
+                for category, tag_list in categorized_tags.items():
+                    categorized_tags[category] = sorted(tag_list, key=lambda tag: -tag_frequencies.get(tag, 0))
             
             # 4. 按正确顺序格式化标签：Artist-Character-Copyright-General-Metadata
             formatted_artists = self._format_tags(categorized_tags['artists'][:max_artists], artist_format, "artist")
@@ -289,6 +1263,12 @@ class GelbooruAccurateExtractor:
             # 6. 收集图片URLs
             image_urls = [post.get("file_url", "") for post in posts_data]
             
+            # 下载图片到本地缓存（与 image_urls 逐行对应，失败的为空行）
+            local_image_paths = []
+            if download_images:
+                self.image_cache.max_bytes = image_cache_max_mb * 1024 * 1024
+                local_image_paths = self._download_images(posts_data)
+            
             # 7. 生成信息
             tag_counts = {
                 'artists': len(categorized_tags['artists']),
@@ -299,6 +1279,17 @@ class GelbooruAccurateExtractor:
             }
             
             tag_info = f"从{site}获取{len(posts_data)}张图片 | " + " | ".join([f"{k}:{v}" for k, v in tag_counts.items()])
+            if tag_frequencies:
+                tag_info += "\n" + self._format_tag_frequencies(
+                    categorized_tags, tag_frequencies,
+                    {'artists': max_artists, 'characters': max_characters, 'copyrights': max_copyrights,
+                     'general': max_general, 'metadata': max_metadata}
+                )
+            
+            pool_stats = get_session_pool_stats()
+            print(f"🔌 连接池: 本次请求 {pool_stats['requests'] - pool_stats_before['requests']}，"
+                  f"新建连接 {pool_stats['connections'] - pool_stats_before['connections']}，"
+                  f"累计复用 {pool_stats['reused']}/{pool_stats['requests']}")
             
             return (
                 combined_tags,
@@ -308,7 +1299,8 @@ class GelbooruAccurateExtractor:
                 formatted_general,
                 formatted_metadata,
                 "\n".join(image_urls),
-                tag_info
+                tag_info,
+                "\n".join(local_image_paths)
             )
             
         except Exception as e:
@@ -317,24 +1309,178 @@ class GelbooruAccurateExtractor:
             return self._empty_result(error_msg)
     
     def _get_posts_data(self, site, OR_tags, AND_tags, exclude_tag, Safe, Questionable, Explicit,
-                       score, count, user_id, api_key):
-        """获取图片数据"""
-        # 处理查询参数
+                       score, count, user_id, api_key, local_dump_path="",
+                       federated_sources="", federated_deadline_seconds=30, rng=random):
+        """获取图片数据
+        
+        site 也可以是 Gelbooru 兼容的自建镜像 API 地址（http/https 开头），查询语法与 Gelbooru 相同。
+        rng 为抽样使用的随机数生成器，在工作线程中调用时应传入独立的 random.Random。
+        """
+        if site == "Federated":
+            return self._get_federated_posts(
+                OR_tags, AND_tags, exclude_tag, Safe, Questionable, Explicit,
+                score, count, user_id, api_key, local_dump_path, federated_sources, federated_deadline_seconds
+            )
+        
+        # 处理查询参数（自建镜像使用 Gelbooru 的查询语法）
+        dialect = "Gelbooru" if self._is_mirror_url(site) else site
         AND_tags_processed = self._process_tags(AND_tags)
-        OR_tags_processed = self._process_or_tags(OR_tags, site)
+        OR_tags_processed = self._process_or_tags(OR_tags, dialect)
         exclude_tag_processed = self._process_exclude_tags(exclude_tag)
-        rate_exclusion = self._build_rating_exclusion(Safe, Questionable, Explicit, site)
+        rate_exclusion = self._build_rating_exclusion(Safe, Questionable, Explicit, dialect)
         
-        # 构建API URL
-        base_url = "https://api.rule34.xxx/index.php" if site == "Rule34" else "https://gelbooru.com/index.php"
-        
-        query_params = (
-            f"page=dapi&s=post&q=index&tags=sort%3arandom+"
-            f"{exclude_tag_processed}+{OR_tags_processed}+{AND_tags_processed}+{rate_exclusion}"
-            f"+score%3a>{score}&api_key={api_key}&user_id={user_id}&limit={count}&json=1"
+        tags_query = (
+            f"sort%3arandom+{exclude_tag_processed}+{OR_tags_processed}+{AND_tags_processed}+{rate_exclusion}"
+            f"+score%3a>{score}"
         )
+        
+        # 本地镜像：用与 API 相同的查询串在倒排索引上查询，不访问网络
+        if site == "Local":
+            if not local_dump_path:
+                raise ValueError("site为Local时需要设置local_dump_path")
+            print("🔍 从本地镜像获取图片数据...")
+            return LocalPostMirror.open(local_dump_path).search(tags_query, count, rng)
+        
+        # 查询缓存：每个TTL内只请求一整页结果，每次在本地按随机种子抽样
+        if self.query_cache.ttl_seconds > 0:
+            posts = self.query_cache.get(site, tags_query)
+            if posts is None:
+                fetch_count = max(self.QUERY_CACHE_PAGE_SIZE, count)
+                posts = self._request_posts(site, tags_query, fetch_count, user_id, api_key, rng)
+                self.query_cache.put(site, tags_query, posts)
+            else:
+                print(f"💾 查询缓存命中: {len(posts)} 张候选图片")
+            return rng.sample(posts, min(count, len(posts)))
+        
+        return self._request_posts(site, tags_query, count, user_id, api_key, rng)
+    
+    @staticmethod
+    def _is_mirror_url(site):
+        return site.startswith(("http://", "https://"))
+    
+    @staticmethod
+    def _is_gelbooru_host(url):
+        host = urllib.parse.urlsplit(url).hostname or ""
+        return host == "gelbooru.com" or host.endswith(".gelbooru.com")
+    
+    def _get_federated_posts(self, OR_tags, AND_tags, exclude_tag, Safe, Questionable, Explicit,
+                             score, count, user_id, api_key, local_dump_path, federated_sources, deadline_seconds):
+        """同时查询多个来源，按 md5 合并去重
+        
+        每个来源使用各自语法翻译后的同一查询并发获取 count 张图片；总时限到达时放弃仍未返回的来源，
+        只使用已返回的结果。合并时按来源轮流取图，使结果混合各来源。
+        节点的 user_id/api_key 只用于 Gelbooru，其他来源使用来源列表中为其单独配置的凭据。
+        各来源在工作线程中使用独立的 random.Random 抽样，种子取自调用线程中已设置种子的 random，
+        因此相同种子下结果可复现，且不会在线程间共享全局随机状态。
+        """
+        sources = self._parse_federated_sources(federated_sources, local_dump_path, user_id, api_key)
+        if not sources:
+            raise ValueError("Federated模式没有可用的来源")
+        print(f"🔍 Federated模式: 同时查询 {len(sources)} 个来源（时限 {deadline_seconds}s）")
+        
+        base_seed = random.getrandbits(64)
+        executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="gelbooru-federated")
+        futures = {
+            executor.submit(self._get_posts_data, source_site, OR_tags, AND_tags, exclude_tag,
+                            Safe, Questionable, Explicit, score, count, source_user_id, source_api_key,
+                            dump_path, rng=random.Random(base_seed + index)): name
+            for index, (name, source_site, dump_path, source_user_id, source_api_key) in enumerate(sources)
+        }
+        done, not_done = wait(futures, timeout=deadline_seconds)
+        # 不等待超时的来源（它们在后台结束后被丢弃）
+        for future in not_done:
+            future.cancel()
+            print(f"⏰ {futures[future]} 未在时限内返回，已放弃")
+        executor.shutdown(wait=False)
+        
+        results = []
+        for future, name in futures.items():
+            if future not in done:
+                continue
+            try:
+                posts = future.result()
+            except Exception as e:
+                print(f"⚠️  {name} 查询失败: {e}")
+                continue
+            print(f"📊 {name}: {len(posts)} 张图片")
+            results.append(posts)
+        
+        # 按来源轮流合并，按 md5（没有时按图片地址）去重
+        merged = []
+        seen = set()
+        for round_posts in zip_longest(*results):
+            for post in round_posts:
+                if post is None:
+                    continue
+                key = post.get("md5") or post.get("file_url") or id(post)
+                if key in seen:
+                    continue
+                seen.add(key)
+                merged.append(post)
+        return merged[:count]
+    
+    def _parse_federated_sources(self, text, local_dump_path, user_id="", api_key=""):
+        """解析来源列表，返回 [(名称, site, 本地导出路径, user_id, api_key)]
+        
+        Gelbooru、Rule34 和镜像地址可以写成 `来源|user_id|api_key` 单独配置凭据；
+        未单独配置时只有 Gelbooru 使用节点的 user_id/api_key，其他来源不带凭据。
+        """
+        sources = []
+        for line in (text or "").splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            line, _, credentials = line.partition("|")
+            line = line.strip()
+            source_user_id, _, source_api_key = credentials.partition("|")
+            source_user_id, source_api_key = source_user_id.strip(), source_api_key.strip()
+            lowered = line.lower()
+            if lowered == "gelbooru":
+                if not credentials:
+                    source_user_id, source_api_key = user_id, api_key
+                sources.append(("Gelbooru", "Gelbooru", "", source_user_id, source_api_key))
+            elif lowered == "rule34":
+                sources.append(("Rule34", "Rule34", "", source_user_id, source_api_key))
+            elif lowered == "local":
+                if local_dump_path:
+                    sources.append(("Local", "Local", local_dump_path, "", ""))
+                else:
+                    print("⚠️  Federated来源Local需要设置local_dump_path，已跳过")
+            elif lowered.startswith("local:"):
+                sources.append((line, "Local", line[len("local:"):].strip(), "", ""))
+            elif self._is_mirror_url(line):
+                sources.append((line, line, "", source_user_id, source_api_key))
+            else:
+                print(f"⚠️  无法识别的Federated来源: {line}")
+        return sources
+    
+    def _build_posts_url(self, site, tags_query, count, user_id, api_key, page=None):
+        """构建帖子 API URL（page 为分页编号 pid）"""
+        if self._is_mirror_url(site):
+            base_url = site
+        else:
+            base_url = "https://api.rule34.xxx/index.php" if site == "Rule34" else "https://gelbooru.com/index.php"
+        
+        query_params = f"page=dapi&s=post&q=index&tags={tags_query}"
+        # 凭据由调用方按来源选择（Federated 模式下节点凭据只给 Gelbooru），这里只附带非空凭据，
+        # 避免向其他站点和镜像发送空的或不属于它们的参数
+        if self._is_gelbooru_host(base_url) or user_id or api_key:
+            query_params += f"&api_key={api_key}&user_id={user_id}"
+        query_params += f"&limit={count}&json=1"
+        if page is not None:
+            query_params += f"&pid={page}"
         url = f"{base_url}?{query_params}".replace("-+", "")
-        url = re.sub(r"\++", "+", url)
+        return re.sub(r"\++", "+", url)
+    
+    def _request_posts(self, site, tags_query, count, user_id, api_key, rng=random):
+        """请求帖子 API（rng 为分页批量获取时抽样使用的随机数生成器）"""
+        page_size = self.POSTS_PAGE_SIZE.get(site, 100)
+        if count > page_size:
+            tags_query = tags_query.replace(self.RANDOM_SORT_TOKEN, "")
+            return self._request_posts_bulk(site, tags_query, count, page_size, user_id, api_key, rng)
+        
+        # 构建API URL
+        url = self._build_posts_url(site, tags_query, count, user_id, api_key)
         
         print(f"🔍 从{site}获取图片数据...")
         
@@ -348,6 +1494,170 @@ class GelbooruAccurateExtractor:
         
         return posts
     
+    def _request_posts_bulk(self, site, tags_query, count, page_size, user_id, api_key, rng=random):
+        """分页批量获取：在可分页范围内随机选页并发请求，流式解析响应，按页去重并蓄水池抽样
+        
+        先查询结果总数，再从前 POSTS_MAX_OFFSET 个结果的所有页中随机选出足够的页，
+        候选帖子数为 count 的 POSTS_BULK_OVERSAMPLE 倍；只保留 count 个抽中的帖子，
+        内存占用与候选数量无关；相同种子和结果集得到相同的抽样。
+        """
+        count = min(count, self.POSTS_MAX_OFFSET)
+        pool_size = min(count * self.POSTS_BULK_OVERSAMPLE, self.POSTS_MAX_OFFSET)
+        total = self._request_posts_total(site, tags_query, user_id, api_key)
+        if total is None:
+            print("⚠️  无法获取结果总数，按默认顺序从第1页开始获取")
+            total = pool_size
+        if total == 0:
+            print(f"📊 {site}没有匹配的图片")
+            return []
+        
+        available_pages = -(-min(total, self.POSTS_MAX_OFFSET) // page_size)
+        page_count = min(-(-pool_size // page_size), available_pages)
+        pages = rng.sample(range(available_pages), page_count)
+        print(f"🔍 从{site}的 {total} 个结果中随机获取 {page_count}/{available_pages} 页候选图片，抽取 {count} 张...")
+        
+        sampled = []
+        seen = set()
+        candidates = 0
+        with ThreadPoolExecutor(max_workers=min(self.POSTS_MAX_WORKERS, page_count)) as executor:
+            futures = [executor.submit(self._request_posts_page, site, tags_query, page_size, page, user_id, api_key)
+                       for page in pages]
+            
+            for index, (page, future) in enumerate(zip(pages, futures)):
+                try:
+                    page_posts = future.result()
+                except Exception as e:
+                    print(f"⚠️  第{page + 1}页获取失败: {e}")
+                    continue
+                # 已处理的页不再保留引用，只有抽中的帖子留在内存中
+                futures[index] = None
+                for post in page_posts:
+                    # 默认顺序下分页期间有新帖子时页边界会移动，仍按帖子去重
+                    post_id = post.get('id') or post.get('md5')
+                    if post_id is not None:
+                        if post_id in seen:
+                            continue
+                        seen.add(post_id)
+                    candidates += 1
+                    if len(sampled) < count:
+                        sampled.append(post)
+                    else:
+                        slot = rng.randrange(candidates)
+                        if slot < count:
+                            sampled[slot] = post
+        
+        rng.shuffle(sampled)
+        print(f"📊 分页获取完成: {candidates} 张候选图片，抽取 {len(sampled)} 张")
+        return sampled
+    
+    def _request_posts_total(self, site, tags_query, user_id, api_key):
+        """查询结果总数（Gelbooru 的 @attributes.count，Rule34 的 XML posts count），获取失败时返回 None"""
+        url = self._build_posts_url(site, tags_query, 1, user_id, api_key)
+        if site == "Rule34":
+            # Rule34 的 JSON 响应只有帖子数组，总数只在 XML 响应中
+            url = url.replace("&json=1", "")
+        self.POSTS_API_RATE_LIMITER.acquire()
+        try:
+            response = make_robust_request(url, timeout=30)
+            if site == "Rule34":
+                match = re.search(r'<posts\b[^>]*\bcount="(\d+)"', response.text)
+                return int(match.group(1)) if match else None
+            return int(response.json().get('@attributes', {})['count'])
+        except Exception as e:
+            print(f"⚠️  结果总数查询失败: {e}")
+            return None
+    
+    def _request_posts_page(self, site, tags_query, page_size, page, user_id, api_key):
+        """请求一页帖子，边接收边解析，每个帖子只保留 BULK_POST_FIELDS"""
+        url = self._build_posts_url(site, tags_query, page_size, user_id, api_key, page=page)
+        self.POSTS_API_RATE_LIMITER.acquire()
+        response = make_robust_request(url, timeout=30, stream=True)
+        try:
+            items = iter_json_array(response.iter_content(chunk_size=65536), key=None if site == "Rule34" else 'post')
+            return [{field: post[field] for field in self.BULK_POST_FIELDS if field in post}
+                    for post in items if isinstance(post, dict)]
+        finally:
+            response.close()
+    
+    def _get_prefetcher(self, query, buffer_size):
+        """返回查询对应的预取缓冲区（不存在时创建）"""
+        cls = type(self)
+        with cls._PREFETCHERS_LOCK:
+            prefetcher = cls._PREFETCHERS.get(query)
+            if prefetcher is None:
+                prefetcher = PostPrefetcher(lambda limit: self._fetch_categorized_posts(query, limit), buffer_size)
+                cls._PREFETCHERS[query] = prefetcher
+                while len(cls._PREFETCHERS) > cls.MAX_PREFETCHERS:
+                    cls._PREFETCHERS.popitem(last=False)
+            else:
+                cls._PREFETCHERS.move_to_end(query)
+            prefetcher.capacity = buffer_size
+        return prefetcher
+    
+    def _fetch_categorized_posts(self, query, limit):
+        """获取一批帖子并分类其标签，返回 [(帖子, 标签 → 类别)]"""
+        (site, OR_tags, AND_tags, exclude_tag, Safe, Questionable, Explicit,
+         score, user_id, api_key, use_tag_api, local_dump_path,
+         federated_sources, federated_deadline_seconds) = query
+        posts = self._get_posts_data(
+            site, OR_tags, AND_tags, exclude_tag, Safe, Questionable, Explicit,
+            score, limit, user_id, api_key, local_dump_path,
+            federated_sources, federated_deadline_seconds
+        )
+        all_tags = self._extract_tags_from_posts(posts)
+        tag_categories = {}
+        if all_tags:
+            categorized = self._categorize_tags_with_api(all_tags, site, user_id, api_key, use_tag_api)
+            for category, tag_list in categorized.items():
+                tag_categories.update(dict.fromkeys(tag_list, category))
+        
+        entries = []
+        for post in posts:
+            post_tags = self._extract_tags_from_posts([post])
+            entries.append((post, {tag: tag_categories[tag] for tag in post_tags if tag in tag_categories}))
+        return entries
+    
+    def _aggregate_tag_frequencies(self, posts, weight_by_score=False):
+        """统计所有图片中每个标签的出现次数，返回 标签 → 频次
+        
+        标签映射为整数编号后用 np.bincount 计数；weight_by_score 时每张图片的权重为
+        1 + ln(1 + max(score, 0))，高分图片中的标签排名更靠前。
+        """
+        # 首次出现的标签自动分配下一个编号
+        tag_ids = defaultdict(count_from().__next__)
+        ids = array('i')
+        lengths = array('i')
+        scores = array('d')
+        for post in posts:
+            post_tags = post.get("tags", "").split()
+            ids.extend(map(tag_ids.__getitem__, post_tags))
+            lengths.append(len(post_tags))
+            if weight_by_score:
+                try:
+                    scores.append(max(float(post.get("score") or 0), 0.0))
+                except (TypeError, ValueError):
+                    scores.append(0.0)
+        if not tag_ids:
+            return {}
+        
+        weights = None
+        if weight_by_score:
+            post_weights = 1.0 + np.log1p(np.frombuffer(scores, dtype=np.float64))
+            weights = np.repeat(post_weights, np.frombuffer(lengths, dtype=np.int32))
+        counts = np.bincount(np.frombuffer(ids, dtype=np.int32), weights=weights, minlength=len(tag_ids))
+        if weights is None:
+            return dict(zip(tag_ids, counts.tolist()))
+        return dict(zip(tag_ids, np.round(counts, 2).tolist()))
+    
+    def _format_tag_frequencies(self, categorized_tags, tag_frequencies, limits):
+        """tag_info 中的频次信息：每个类别输出的标签及其频次"""
+        lines = []
+        for category, tag_list in categorized_tags.items():
+            kept = tag_list[:limits.get(category, len(tag_list))]
+            if kept:
+                lines.append(f"{category}: " + ", ".join(f"{tag}×{tag_frequencies.get(tag, 0):g}" for tag in kept))
+        return "\n".join(lines)
+    
     def _extract_tags_from_posts(self, posts):
         """从图片数据中提取所有标签"""
         all_tags = []
@@ -362,61 +1672,172 @@ class GelbooruAccurateExtractor:
         return unique_tags
     
     def _categorize_tags_with_api(self, tags, site, user_id, api_key, use_tag_api):
-        """使用Gelbooru Tag API获取准确的标签分类"""
-        categorized = {
-            'artists': [],
-            'characters': [],
-            'copyrights': [],
-            'general': [],
-            'metadata': []
-        }
+        """使用Gelbooru Tag API获取准确的标签分类
         
-        if site != "Gelbooru" or not use_tag_api or not user_id or not api_key:
-            print("⚠️  跳过Tag API，使用备用分类方法")
-            return self._fallback_categorize_tags(tags)
+        先用本地 danbooru_tags.csv 的类别代码分类，只有本地表中没有的标签才请求 Tag API；
+        不使用 Tag API（未启用、缺少凭据或 Rule34）时，本地表未覆盖的标签使用备用分类。
+        结果按标签在图片中出现的顺序排列。
+        """
+        # 标签 → 类别（本地表、Tag API 或备用分类的结果）
+        tag_categories = {}
         
-        print(f"🔍 使用Tag API获取{len(tags)}个标签的准确分类...")
+        local_types = self._get_local_tag_types(tags)
+        for tag, tag_type in local_types.items():
+            tag_categories[tag] = self.gelbooru_tag_types.get(tag_type, 'general')
+        remaining_tags = [tag for tag in tags if tag not in local_types]
+        print(f"📚 本地标签表分类了 {len(local_types)}/{len(tags)} 个标签")
         
-        # 分批处理标签，避免URL过长
-        batch_size = 20
-        for i in range(0, len(tags), batch_size):
-            batch_tags = tags[i:i+batch_size]
+        # Federated 模式的标签同样使用 Gelbooru Tag API 查询
+        if site not in ("Gelbooru", "Federated") or not use_tag_api or not user_id or not api_key:
+            if remaining_tags:
+                print("⚠️  跳过Tag API，其余标签使用备用分类方法")
+                for category, tag_list in self._fallback_categorize_tags(remaining_tags).items():
+                    tag_categories.update(dict.fromkeys(tag_list, category))
+            return self._group_tags_by_category(tags, tag_categories)
+        
+        if remaining_tags:
+            print(f"🔍 使用Tag API获取{len(remaining_tags)}个标签的准确分类...")
+        
+        # 按URL长度分批，多个批次并发请求（由令牌桶限速），结果按批次顺序处理
+        batches = self._build_tag_batches(remaining_tags)
+        futures = []
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(self.TAG_API_MAX_WORKERS, len(batches))) as executor:
+                futures = [executor.submit(self._get_tag_types_batch, batch_tags, user_id, api_key)
+                           for batch_tags in batches]
+        
+        for i, (batch_tags, future) in enumerate(zip(batches, futures)):
             try:
-                batch_result = self._get_tag_types_batch(batch_tags, user_id, api_key)
+                batch_result = future.result()
                 
                 for tag, tag_type in batch_result.items():
                     if tag_type in self.gelbooru_tag_types:
                         category = self.gelbooru_tag_types[tag_type]
-                        categorized[category].append(tag)
+                        tag_categories[tag] = category
                         print(f"✅ {tag} -> {category} (type {tag_type})")
                     else:
                         # 未知类型，归为general
-                        categorized['general'].append(tag)
+                        tag_categories[tag] = 'general'
                         print(f"⚠️  {tag} -> general (unknown type {tag_type})")
                 
-                # 添加延迟避免API限制
-                time.sleep(0.1)
-                
             except Exception as e:
-                print(f"⚠️  批次{i//batch_size + 1}处理失败: {e}")
+                print(f"⚠️  批次{i + 1}处理失败: {e}")
                 # 对失败的批次使用备用分类
-                print(f"⚠️  对批次{i//batch_size + 1}使用备用分类: {batch_tags}")
+                print(f"⚠️  对批次{i + 1}使用备用分类: {batch_tags}")
                 fallback_result = self._fallback_categorize_tags(batch_tags)
                 for category, tag_list in fallback_result.items():
                     if tag_list:
                         print(f"📋 备用分类 {category}: {tag_list}")
-                        categorized[category].extend(tag_list)
+                        tag_categories.update(dict.fromkeys(tag_list, category))
         
+        return self._group_tags_by_category(tags, tag_categories)
+    
+    def _build_tag_batches(self, tags):
+        """按 names 参数的URL编码长度把标签装入批次，避免URL过长"""
+        batches = []
+        batch = []
+        batch_length = 0
+        for tag in tags:
+            # 标签之间的空格编码为 %20
+            tag_length = len(urllib.parse.quote(tag)) + 3
+            if batch and (batch_length + tag_length > self.TAG_API_MAX_NAMES_LENGTH
+                          or len(batch) >= self.TAG_API_MAX_BATCH_TAGS):
+                batches.append(batch)
+                batch = []
+                batch_length = 0
+            batch.append(tag)
+            batch_length += tag_length
+        if batch:
+            batches.append(batch)
+        return batches
+    
+    def _group_tags_by_category(self, tags, tag_categories):
+        """按标签顺序分组；Tag API 没有返回的标签被丢弃，API 返回的额外名称排在最后"""
+        categorized = {
+            'artists': [],
+            'characters': [],
+            'copyrights': [],
+            'general': [],
+            'metadata': []
+        }
+        for tag in dict.fromkeys(list(tags) + list(tag_categories)):
+            category = tag_categories.get(tag)
+            if category is not None:
+                categorized[category].append(tag)
         return categorized
     
+    @classmethod
+    def _get_local_tag_types(cls, tags):
+        """从本地 danbooru_tags.csv 查找标签类型代码（与 gelbooru_tag_types 的编码一致）"""
+        local_table = cls._load_local_tag_table()
+        local_types = {}
+        for tag in tags:
+            tag_type = local_table.get(tag)
+            if tag_type is None:
+                tag_type = local_table.get(tag.lower())
+            if tag_type is not None:
+                local_types[tag] = tag_type
+        return local_types
+    
+    @classmethod
+    def _load_local_tag_table(cls):
+        """加载（并缓存）本地标签表：标签 → 类别代码"""
+        if cls._LOCAL_TAG_TYPES is not None:
+            return cls._LOCAL_TAG_TYPES
+        
+        import csv
+        local_table = {}
+        plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        table_path = os.path.join(plugin_dir, *cls.LOCAL_TAG_TABLE)
+        try:
+            with open(table_path, 'r', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    tag = (row.get('tag') or '').strip().lower()
+                    try:
+                        tag_type = int(row.get('category') or '')
+                    except ValueError:
+                        continue
+                    if tag:
+                        local_table[tag] = tag_type
+            print(f"📚 加载本地标签表: {len(local_table)} 个标签")
+        except OSError as e:
+            print(f"⚠️  本地标签表不可用: {e}")
+        
+        cls._LOCAL_TAG_TYPES = local_table
+        return local_table
+    
     def _get_tag_types_batch(self, tags, user_id, api_key):
-        """批量获取标签类型"""
+        """批量获取标签类型（优先使用本地缓存，只请求缺失或过期的标签）
+        
+        返回结果按批次内标签的顺序排列，与是否命中缓存无关。
+        """
+        cached_types = self.tag_cache.get_many("Gelbooru", tags)
+        missing_tags = [tag for tag in tags if tag not in cached_types]
+        if cached_types:
+            print(f"💾 标签类型缓存命中 {len(cached_types)}/{len(tags)}")
+        
+        fetched_types = self._request_tag_types(missing_tags, user_id, api_key) if missing_tags else {}
+        self.tag_cache.put_many("Gelbooru", fetched_types)
+        
+        tag_types = {}
+        for tag in tags:
+            if tag in cached_types:
+                tag_types[tag] = cached_types[tag]
+            elif tag in fetched_types:
+                tag_types[tag] = fetched_types[tag]
+        # API 返回的名称与请求不完全一致时（如大小写不同）保留在末尾
+        for tag, tag_type in fetched_types.items():
+            tag_types.setdefault(tag, tag_type)
+        return tag_types
+    
+    def _request_tag_types(self, tags, user_id, api_key):
+        """请求 Tag API 获取标签类型"""
         # 使用Gelbooru Tag API的names参数，需要进行URL编码
-        import urllib.parse
         names_param = " ".join(tags)
         names_encoded = urllib.parse.quote(names_param)
-        url = f"https://gelbooru.com/index.php?page=dapi&s=tag&q=index&names={names_encoded}&api_key={api_key}&user_id={user_id}&json=1"
+        url = f"https://gelbooru.com/index.php?page=dapi&s=tag&q=index&names={names_encoded}&limit={len(tags)}&api_key={api_key}&user_id={user_id}&json=1"
         
+        self.TAG_API_RATE_LIMITER.acquire()
         print(f"🔍 Tag API请求: {url[:100]}...")
         response = make_robust_request(url, timeout=15)
         tag_data = response.json()
@@ -459,60 +1880,56 @@ class GelbooruAccurateExtractor:
         return tag_types
     
     def _fallback_categorize_tags(self, tags):
-        """备用的标签分类方法（基于模式匹配）"""
-        categorized = {
-            'artists': [],
-            'characters': [],
-            'copyrights': [],
-            'general': [],
-            'metadata': []
-        }
+        """备用的标签分类方法（基于模式匹配）
         
-        for tag in tags:
-            tag_lower = tag.lower()
-            
-            # 元数据标签
-            if any(pattern in tag_lower for pattern in self.fallback_metadata_patterns):
-                categorized['metadata'].append(tag)
-            # 画师标签
-            elif any(pattern in tag_lower for pattern in self.fallback_artist_patterns) or self._is_likely_artist(tag):
-                categorized['artists'].append(tag)
-            # 角色标签
-            elif any(re.search(pattern, tag_lower) for pattern in self.fallback_character_patterns) or self._is_likely_character(tag):
-                categorized['characters'].append(tag)
-            # 版权标签
-            elif any(pattern in tag_lower for pattern in self.fallback_copyright_patterns) or self._is_likely_copyright(tag):
-                categorized['copyrights'].append(tag)
-            # 其他归为一般标签
-            else:
-                categorized['general'].append(tag)
-        
-        return categorized
+        判定顺序：元数据 → 画师 → 角色 → 版权 → 一般。
+        元数据、画师、版权列表为子串匹配，角色列表为正则匹配，另外各自加上 _is_likely_* 的正则。
+        """
+        return self._get_fallback_categorizer().categorize_all(tags)
+    
+    def _get_fallback_categorizer(self):
+        """获取由当前模式列表编译的分类器（相同列表只编译一次）"""
+        cache_key = (
+            tuple(self.fallback_metadata_patterns), tuple(self.fallback_artist_patterns),
+            tuple(self.fallback_character_patterns), tuple(self.fallback_copyright_patterns),
+        )
+        categorizer = self._FALLBACK_CATEGORIZER_CACHE.get(cache_key)
+        if categorizer is None:
+            categorizer = FallbackTagCategorizer(
+                {
+                    'metadata': self.fallback_metadata_patterns,
+                    'artists': self.fallback_artist_patterns,
+                    'copyrights': self.fallback_copyright_patterns,
+                },
+                {
+                    'artists': self.LIKELY_ARTIST_PATTERNS,
+                    'characters': list(self.fallback_character_patterns) + list(self.LIKELY_CHARACTER_PATTERNS),
+                    'copyrights': self.LIKELY_COPYRIGHT_PATTERNS,
+                },
+            )
+            self._FALLBACK_CATEGORIZER_CACHE[cache_key] = categorizer
+        return categorizer
+    
+    @classmethod
+    def _likely_regex(cls, patterns):
+        """将补充正则列表编译为一个交替式"""
+        regex = cls._LIKELY_REGEX_CACHE.get(patterns)
+        if regex is None:
+            regex = cls._LIKELY_REGEX_CACHE[patterns] = re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+        return regex
     
     def _is_likely_artist(self, tag):
         """判断是否可能是画师标签"""
         # 更严格的画师判断，避免误分类
-        artist_patterns = [
-            r'^[a-z]+_[a-z]+_artist$',  # 明确的画师标签
-            r'^\w+_\(artist\)$',        # 带(artist)标记的
-        ]
-        return any(re.search(pattern, tag.lower()) for pattern in artist_patterns)
+        return self._likely_regex(self.LIKELY_ARTIST_PATTERNS).search(tag.lower()) is not None
     
     def _is_likely_character(self, tag):
         """判断是否可能是角色标签"""
-        character_patterns = [
-            r'.*_\(.*\)$',       # 带括号的角色名
-        ]
-        return any(re.search(pattern, tag.lower()) for pattern in character_patterns)
+        return self._likely_regex(self.LIKELY_CHARACTER_PATTERNS).search(tag.lower()) is not None
     
     def _is_likely_copyright(self, tag):
         """判断是否可能是版权标签"""
-        copyright_patterns = [
-            r'.*_series$',       # 系列名
-            r'.*_game$',         # 游戏名
-            r'.*_anime$',        # 动画名
-        ]
-        return any(re.search(pattern, tag.lower()) for pattern in copyright_patterns)
+        return self._likely_regex(self.LIKELY_COPYRIGHT_PATTERNS).search(tag.lower()) is not None
     
     def _process_tags(self, tags_str):
         """处理AND标签"""
@@ -549,19 +1966,19 @@ class GelbooruAccurateExtractor:
         if not Safe: 
             if site == "Rule34":
                 rate_exclusion += "+-rating%3asafe"
-            elif site == "Gelbooru":
+            elif site in ("Gelbooru", "Local"):
                 rate_exclusion += "+-rating%3ageneral"
         
         if not Questionable: 
             if site == "Rule34":
                 rate_exclusion += "+-rating%3aquestionable" 
-            elif site == "Gelbooru":
+            elif site in ("Gelbooru", "Local"):
                 rate_exclusion += "+-rating%3aquestionable+-rating%3aSensitive"
         
         if not Explicit: 
             if site == "Rule34":
                 rate_exclusion += "+-rating%3aexplicit" 
-            elif site == "Gelbooru":
+            elif site in ("Gelbooru", "Local"):
                 rate_exclusion += "+-rating%3aexplicit"
         
         return rate_exclusion
@@ -606,9 +2023,32 @@ class GelbooruAccurateExtractor:
         
         return sep.join(result_parts)
     
+    def _download_images(self, posts):
+        """并发下载图片（共享连接池），返回与帖子顺序一致的本地路径"""
+        def fetch(post):
+            url = post.get("file_url", "")
+            if not url:
+                return ""
+            try:
+                return self.image_cache.fetch(url, post.get("md5"))
+            except Exception as e:
+                print(f"⚠️  图片下载失败: {url[:60]} - {e}")
+                return ""
+        
+        stats_before = dict(self.image_cache.stats)
+        with ThreadPoolExecutor(max_workers=self.IMAGE_DOWNLOAD_WORKERS) as executor:
+            paths = list(executor.map(fetch, posts))
+        self.image_cache.evict(keep=[path for path in paths if path])
+        
+        stats = self.image_cache.stats
+        print(f"🖼️  图片缓存: 命中 {stats['hits'] - stats_before['hits']}，"
+              f"下载 {stats['downloads'] - stats_before['downloads']} 张 "
+              f"({(stats['bytes'] - stats_before['bytes']) / 1024 / 1024:.1f}MB)")
+        return paths
+    
     def _empty_result(self, error_msg):
         """返回空结果"""
-        return ("", "", "", "", "", "", "", error_msg)
+        return ("", "", "", "", "", "", "", error_msg, "")
 
 
 # 节点映射
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Advanced Prompt Processor - Gelbooru备用分类基准测试
+对比原先逐条扫描模式列表的备用分类与预编译的 FallbackTagCategorizer，验证结果一致并统计吞吐量
+
+用法: python scripts/benchmark_gelbooru_fallback.py [标签数量]
+"""
+
+import os
+import re
+import sys
+import csv
+import time
+import random
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from nodes.gelbooru_accurate_extractor import GelbooruAccurateExtractor
+
+
+def legacy_fallback_categorize(extractor, tags):
+    """原先的备用分类实现（逐条子串扫描，每个标签重新构建并匹配正则）"""
+    categorized = {'artists': [], 'characters': [], 'copyrights': [], 'general': [], 'metadata': []}
+
+    def is_likely_artist(tag):
+        patterns = [r'^[a-z]+_[a-z]+_artist$', r'^\w+_\(artist\)$']
+        return any(re.search(pattern, tag.lower()) for pattern in patterns)
+
+    def is_likely_character(tag):
+        patterns = [r'.*_\(.*\)$']
+        return any(re.search(pattern, tag.lower()) for pattern in patterns)
+
+    def is_likely_copyright(tag):
+        patterns = [r'.*_series$', r'.*_game$', r'.*_anime$']
+        return any(re.search(pattern, tag.lower()) for pattern in patterns)
+
+    for tag in tags:
+        tag_lower = tag.lower()
+        if any(pattern in tag_lower for pattern in extractor.fallback_metadata_patterns):
+            categorized['metadata'].append(tag)
+        elif any(pattern in tag_lower for pattern in extractor.fallback_artist_patterns) or is_likely_artist(tag):
+            categorized['artists'].append(tag)
+        elif any(re.search(pattern, tag_lower) for pattern in extractor.fallback_character_patterns) or is_likely_character(tag):
+            categorized['characters'].append(tag)
+        elif any(pattern in tag_lower for pattern in extractor.fallback_copyright_patterns) or is_likely_copyright(tag):
+            categorized['copyrights'].append(tag)
+        else:
+            categorized['general'].append(tag)
+
+    return categorized
+
+
+def load_sample_tags(count, seed=42):
+    """从 danbooru_tags.csv 取真实标签，并混入大小写、后缀和特殊字符的变体"""
+    rng = random.Random(seed)
+    tags = []
+    csv_path = os.path.join(ROOT_DIR, "Tag knowledge", "danbooru_tags.csv")
+    if os.path.exists(csv_path):
+        with open(csv_path, 'r', encoding='utf-8') as f:
+            tags = [row['tag'] for row in csv.DictReader(f) if row.get('tag')]
+
+    decorations = ["", "_series", "_game$", "_(artist)", "_(Fate)", "_artist", "Girl", "$", "_CHAN",
+                   "fate/", "rating:", "has_", "_series$x", "é", "kun"]
+    words = tags or ["tag"]
+    sample = []
+    for _ in range(count):
+        tag = rng.choice(words)
+        if rng.random() < 0.4:
+            tag = tag + rng.choice(decorations) if rng.random() < 0.7 else rng.choice(decorations) + tag
+        if rng.random() < 0.1:
+            tag = tag.upper()
+        sample.append(tag)
+    return sample
+
+
+def benchmark(function, rounds=3):
+    """返回最快一轮的耗时（秒）和结果"""
+    best = None
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    extractor = GelbooruAccurateExtractor()
+    tags = load_sample_tags(count)
+
+    legacy_time, legacy_result = benchmark(lambda: legacy_fallback_categorize(extractor, tags))
+    compiled_time, compiled_result = benchmark(lambda: extractor._fallback_categorize_tags(tags))
+
+    # 典型一次抽取：40张图片 × 30个标签
+    pull = tags[:1200]
+    pull_legacy, _ = benchmark(lambda: legacy_fallback_categorize(extractor, pull), rounds=10)
+    pull_compiled, _ = benchmark(lambda: extractor._fallback_categorize_tags(pull), rounds=10)
+
+    print(f"📊 标签数量: {count}")
+    print(f"   原实现: {legacy_time:.3f}s ({count / legacy_time:,.0f} 标签/秒)")
+    print(f"   预编译: {compiled_time:.3f}s ({count / compiled_time:,.0f} 标签/秒)")
+    print(f"   加速比: {legacy_time / compiled_time:.2f}x")
+    print(f"   单次抽取(1200个标签): {pull_legacy * 1000:.1f}ms → {pull_compiled * 1000:.1f}ms")
+
+    if legacy_result != compiled_result:
+        for category in legacy_result:
+            if legacy_result[category] != compiled_result[category]:
+                print(f"❌ {category} 分类结果不一致")
+        return 1
+    print("✅ 两种实现的分类结果完全一致")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Advanced Prompt Processor - 启发式规则基准测试
+对比逐条匹配正则与合并后的 TagRuleMatcher，在大量未知标签上验证结果一致并统计吞吐量
+
+用法: python scripts/benchmark_tag_rules.py [标签数量]
+"""
+
+import os
+import sys
+import time
+import random
+import string
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nodes.advanced_prompt_processor import AdvancedPromptProcessor
+
+
+def generate_unknown_tags(count, seed=42):
+    """生成覆盖各类规则的未知标签（后缀、角色形状、画师前缀、大小写和非ASCII混合）"""
+    rng = random.Random(seed)
+    suffixes = ["_hair", "_eyes", "_clothes", "_dress", "_shirt", "_mouth", "_pupils", "_polish",
+                "_art", "_nails", "_fingernails", "_eyelashes", "_makeup", "_uniform", "_hat", ""]
+    words = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9))) for _ in range(2000)]
+    words += ["Miku", "REMILIA", "café", "少女", "x", "by", "artist"]
+
+    tags = []
+    for _ in range(count):
+        shape = rng.random()
+        if shape < 0.3:
+            tag = "_".join(rng.sample(words, rng.randint(1, 3))) + rng.choice(suffixes)
+        elif shape < 0.5:
+            tag = f"{rng.choice(words)} ({rng.choice(words)})"
+        elif shape < 0.6:
+            tag = rng.choice(["by ", "artist:", "by", "Artist:"]) + rng.choice(words)
+        elif shape < 0.8:
+            tag = " ".join(rng.sample(words, rng.randint(1, 4)))
+        else:
+            tag = rng.choice(words).upper() + rng.choice(suffixes).upper()
+        tags.append(tag)
+    return tags
+
+
+def classify_with_separate_patterns(processor, tag):
+    """原先的逐条匹配逻辑（未知标签部分）"""
+    tag_lower = tag.lower().strip()
+    for pattern in processor.non_character_patterns:
+        if pattern.match(tag_lower):
+            return "general"
+    for pattern in processor.character_patterns:
+        if pattern.match(tag):
+            return "characters"
+    for pattern in processor.artist_patterns:
+        if pattern.match(tag):
+            return "artists"
+    return None
+
+
+def classify_with_combined_rules(processor, tag):
+    """合并规则的匹配逻辑"""
+    if processor.non_character_rules.match(tag.lower().strip()):
+        return "general"
+    return processor.shape_rules.match(tag)
+
+
+def benchmark(function, processor, tags, rounds=3):
+    """返回最快一轮的耗时（秒）和分类结果"""
+    best = None
+    results = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        results = [function(processor, tag) for tag in tags]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    processor = AdvancedPromptProcessor()
+    tags = generate_unknown_tags(count)
+
+    separate_time, separate_results = benchmark(classify_with_separate_patterns, processor, tags)
+    combined_time, combined_results = benchmark(classify_with_combined_rules, processor, tags)
+
+    mismatches = [tag for tag, a, b in zip(tags, separate_results, combined_results) if a != b]
+
+    print(f"📊 未知标签数量: {count}")
+    print(f"   逐条匹配: {separate_time:.3f}s ({count / separate_time:,.0f} 标签/秒)")
+    print(f"   合并规则: {combined_time:.3f}s ({count / combined_time:,.0f} 标签/秒)")
+    print(f"   加速比: {separate_time / combined_time:.2f}x")
+
+    if mismatches:
+        print(f"❌ 结果不一致: {len(mismatches)} 个，例如 {mismatches[:5]}")
+        return 1
+    print("✅ 两种实现的分类结果完全一致")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Advanced Prompt Processor - Gelbooru请求行为检查
+在本地HTTP桩服务器上统计实际发出的请求次数，验证连接回退不会重复发送请求、
+分页批量获取的请求数和抽样范围覆盖全部可分页的结果、图片缓存的命中与 md5 校验
+
+用法: python scripts/check_gelbooru_requests.py
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import hashlib
+import tempfile
+import threading
+import contextlib
+import urllib.parse
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nodes.gelbooru_accurate_extractor as extractor_module
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """按路径返回不同响应：/slow 延迟2.5秒，/error 返回500，/index.php 模拟帖子API，
+    /images/ 下返回固定的图片内容，其余返回200"""
+    protocol_version = 'HTTP/1.1'
+    hits = Counter()
+    hits_lock = threading.Lock()
+    # 模拟帖子API的结果总数，帖子按默认顺序（最新在前）编号
+    total_posts = 5000
+    image_body = b'\x89PNG' + bytes(range(256)) * 64
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        with self.hits_lock:
+            self.hits[path] += 1
+        if path == '/slow':
+            time.sleep(2.5)
+        if path == '/index.php':
+            body = self.posts_body(urllib.parse.parse_qs(query))
+        elif path.startswith('/images/'):
+            body = self.image_body
+        else:
+            body = b'[]'
+        self.send_response(500 if path == '/error' else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def posts_body(self, params):
+        limit = int(params['limit'][0])
+        offset = int(params.get('pid', ['0'])[0]) * limit
+        ranks = range(offset, min(offset + limit, self.total_posts))
+        posts = [{'id': self.total_posts - rank, 'md5': f'{rank:032x}', 'tags': 'tag_a tag_b'} for rank in ranks]
+        return json.dumps({'@attributes': {'limit': limit, 'offset': offset, 'count': self.total_posts},
+                           'post': posts}).encode()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def check_connection_fallback(base_url):
+    """慢响应、5xx 重试和代理失败时，每轮只向服务器发出一个请求"""
+    failures = []
+    hits = StubHandler.hits
+
+    make = extractor_module.make_robust_request
+    make(f"{base_url}/slow", timeout=10).close()
+    if hits['/slow'] != 1:
+        failures.append(f"慢响应被重复请求 {hits['/slow']} 次（应为1次）")
+
+    try:
+        make(f"{base_url}/error", timeout=5, max_retries=2, deadline=20)
+        failures.append("HTTP 500 没有抛出异常")
+    except requests.exceptions.ConnectTimeout:
+        pass
+    if hits['/error'] != 3:
+        failures.append(f"HTTP 500 重试发出 {hits['/error']} 次请求（应为3次：1次 + 2次重试）")
+
+    # 代理不可用（连接被拒绝）时回退到直连，服务器只收到直连的一次请求
+    extractor_module._PREFERRED_VARIANTS.clear()
+    saved = {name: os.environ.get(name) for name in ('HTTP_PROXY', 'http_proxy', 'NO_PROXY', 'no_proxy')}
+    os.environ['HTTP_PROXY'] = 'http://127.0.0.1:9'
+    for name in ('http_proxy', 'NO_PROXY', 'no_proxy'):
+        os.environ.pop(name, None)
+    try:
+        make(f"{base_url}/proxy", timeout=5).close()
+    except requests.exceptions.RequestException as e:
+        failures.append(f"代理失败后没有回退到直连: {e}")
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    if extractor_module.get_preferred_connection_variants().get(base_url.split('//')[1]) != "直连":
+        failures.append("代理失败后没有记住直连方式")
+    if hits['/proxy'] != 1:
+        failures.append(f"代理回退后服务器收到 {hits['/proxy']} 次请求（应为1次）")
+    return failures
+
+
+def check_bulk_sampling(base_url):
+    """分页批量获取：请求数为 1次总数查询 + 所需页数，抽样覆盖全部结果而不是只有最新的帖子"""
+    from nodes.gelbooru_accurate_extractor import GelbooruAccurateExtractor
+
+    failures = []
+    extractor = GelbooruAccurateExtractor()
+    site = f"{base_url}/index.php"
+    count = 300
+    total = StubHandler.total_posts
+    expected_requests = 1 + count * extractor.POSTS_BULK_OVERSAMPLE // 100
+    mean_ranks = []
+    for seed in range(5):
+        before = StubHandler.hits['/index.php']
+        with contextlib.redirect_stdout(io.StringIO()):
+            posts = extractor._request_posts(site, "sort%3arandom+tag_a", count, "", "", random.Random(seed))
+        requests_made = StubHandler.hits['/index.php'] - before
+        if requests_made != expected_requests:
+            failures.append(f"种子{seed}: 发出 {requests_made} 次请求（应为{expected_requests}次）")
+        ids = [post['id'] for post in posts]
+        if len(ids) != count or len(set(ids)) != count:
+            failures.append(f"种子{seed}: 得到 {len(ids)} 个帖子，其中 {len(set(ids))} 个不重复（应为{count}个）")
+        if ids:
+            mean_ranks.append(sum(total - post_id for post_id in ids) / len(ids))
+
+    # 均匀抽样时平均排名接近总数的一半；只从最新的 2×count 个帖子中抽样时约为 count
+    mean_rank = sum(mean_ranks) / max(len(mean_ranks), 1)
+    if not total * 0.35 < mean_rank < total * 0.65:
+        failures.append(f"抽样偏向部分结果: 平均排名 {mean_rank:.0f}（总数 {total}）")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        first = extractor._request_posts(site, "tag_a", count, "", "", random.Random(7))
+        second = extractor._request_posts(site, "tag_a", count, "", "", random.Random(7))
+    if [post['id'] for post in first] != [post['id'] for post in second]:
+        failures.append("相同种子的抽样结果不一致")
+    return failures
+
+
+def check_image_cache(base_url):
+    """图片缓存：第二次获取命中不再下载；md5 不一致时抛出异常且不留下任何文件"""
+    from nodes.gelbooru_accurate_extractor import ImageDownloadCache
+
+    failures = []
+    md5 = hashlib.md5(StubHandler.image_body).hexdigest()
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ImageDownloadCache(directory, 1 << 30)
+        with contextlib.redirect_stdout(io.StringIO()):
+            first = cache.fetch(f"{base_url}/images/{md5}.png", md5)
+            second = cache.fetch(f"{base_url}/images/{md5}.png", md5)
+        if first != second or StubHandler.hits[f'/images/{md5}.png'] != 1:
+            failures.append(f"重复获取同一图片下载了 {StubHandler.hits[f'/images/{md5}.png']} 次（应为1次）")
+
+        wrong_md5 = 'f' * 32
+        for attempt in range(2):
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    cache.fetch(f"{base_url}/images/{wrong_md5}.png", wrong_md5)
+                failures.append("md5 不一致时没有抛出异常")
+            except ValueError:
+                pass
+        files = sorted(name for _, _, names in os.walk(directory) for name in names)
+        if files != [f"{md5}.png"]:
+            failures.append(f"md5 不一致后缓存目录中的文件: {files}（应只有 {md5}.png）")
+    return failures
+
+
+def main():
+    server, base_url = start_stub_server()
+    checks = [
+        ("连接回退请求次数", lambda: check_connection_fallback(base_url)),
+        ("分页批量获取", lambda: check_bulk_sampling(base_url)),
+        ("图片缓存", lambda: check_image_cache(base_url)),
+    ]
+    failed = False
+    try:
+        for name, check in checks:
+            failures = check()
+            if failures:
+                failed = True
+                for failure in failures:
+                    print(f"❌ {name}: {failure}")
+            else:
+                print(f"✅ {name}")
+    finally:
+        server.shutdown()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
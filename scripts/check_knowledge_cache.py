@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Advanced Prompt Processor - 知识库缓存检查
+在 Tag knowledge 的临时副本上验证：从快照加载与解析CSV得到的知识库和分类结果完全一致，
+mmap 与内存存储的分类结果一致且自动选择的存储模式在冷启动和快照加载时相同、
+多个线程同时首次加载时只加载一次、缓存命中不访问文件系统，并统计冷启动（解析CSV）与快照加载的耗时
+
+用法: python scripts/check_knowledge_cache.py [提示词数量]
+"""
+
+import os
+import io
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+import contextlib
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from nodes.advanced_prompt_processor import AdvancedPromptProcessor, MappedTagKnowledgeBase, TagKnowledgeSnapshot
+
+
+def copy_knowledge_folder(target):
+    """复制知识库源文件（不含快照）"""
+    source = os.path.join(ROOT_DIR, AdvancedPromptProcessor.KNOWLEDGE_BASE_PATH)
+    for name in os.listdir(source):
+        if not name.startswith('.'):
+            shutil.copy2(os.path.join(source, name), target)
+
+
+def load_fresh(processor, folder_path):
+    """清空进程内缓存后加载一次，返回 (知识库, 耗时秒)"""
+    AdvancedPromptProcessor._KNOWLEDGE_CACHE.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        knowledge_base = processor.load_knowledge_base_from_folder(folder_path)
+        elapsed = time.perf_counter() - start
+    return knowledge_base, elapsed
+
+
+@contextlib.contextmanager
+def storage_mode(mode):
+    """临时指定知识库存储模式"""
+    previous = AdvancedPromptProcessor.KNOWLEDGE_STORAGE_MODE
+    AdvancedPromptProcessor.KNOWLEDGE_STORAGE_MODE = mode
+    try:
+        yield
+    finally:
+        AdvancedPromptProcessor.KNOWLEDGE_STORAGE_MODE = previous
+
+
+def wait_for_snapshot_writers():
+    for thread in threading.enumerate():
+        if thread.name == "TagKnowledgeSnapshotWriter":
+            thread.join()
+
+
+def generate_prompts(knowledge_base, count, seed=42):
+    """混合各类别的已知标签、别名和未知标签生成提示词"""
+    rng = random.Random(seed)
+    known = sorted(tag for tags in knowledge_base.values() for tag in tags)
+    aliases = sorted(alias for alias, _ in knowledge_base.aliases.items())
+    unknown = ["zz_unknown_tag", "Hatsune Miku", "by someone", "long hair", "(masterpiece:1.2)", "LONG_HAIR"]
+    prompts = []
+    for _ in range(count):
+        tags = rng.sample(known, 20) + rng.sample(aliases, 5) + rng.sample(unknown, 2)
+        rng.shuffle(tags)
+        prompts.append(", ".join(tags))
+    return prompts
+
+
+def compare_knowledge_bases(expected, actual):
+    """比较类别集合、别名和使用次数，返回不一致的描述"""
+    failures = []
+    for category in AdvancedPromptProcessor.TAG_CATEGORIES:
+        if set(expected.get(category, ())) != set(actual.get(category, ())):
+            failures.append(f"类别 {category} 的标签不一致")
+    if dict(expected.aliases.items()) != dict(actual.aliases.items()):
+        failures.append("别名索引不一致")
+    # 快照只保存已知标签和别名目标的使用次数（其余标签不参与分类、纠错和主题提取）
+    tags = {tag for tags in expected.values() for tag in tags} | set(expected.aliases.values())
+    if any(expected.tag_counts.get(tag, 0) != actual.tag_counts.get(tag, 0) for tag in tags):
+        failures.append("使用次数不一致")
+    return failures
+
+
+def compare_classification(processor, expected, actual, prompts):
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected_results = list(processor.classify_tags_batch(prompts, expected))
+        actual_results = list(processor.classify_tags_batch(prompts, actual))
+    mismatches = sum(1 for a, b in zip(expected_results, actual_results) if a != b)
+    return [f"{mismatches}/{len(prompts)} 条提示词的分类结果不一致"] if mismatches else []
+
+
+def check_snapshot_parity(processor, folder_path, prompt_count):
+    """内存存储模式下快照加载与解析CSV的结果一致，快照由后台线程写出"""
+    with storage_mode("memory"):
+        csv_kb, cold_time = load_fresh(processor, folder_path)
+        wait_for_snapshot_writers()
+        if not os.path.exists(os.path.join(folder_path, TagKnowledgeSnapshot.FILENAME)):
+            return ["冷启动后没有写出快照"]
+        snapshot_kb, warm_time = load_fresh(processor, folder_path)
+    if getattr(snapshot_kb, 'snapshot', None) is None:
+        return ["第二次加载没有使用快照"]
+    print(f"   冷启动(解析CSV): {cold_time * 1000:.1f}ms，快照加载: {warm_time * 1000:.1f}ms")
+
+    failures = compare_knowledge_bases(csv_kb, snapshot_kb)
+    failures += compare_classification(processor, csv_kb, snapshot_kb, generate_prompts(csv_kb, prompt_count))
+    return failures
+
+
+def check_storage_parity(processor, folder_path, prompt_count):
+    """mmap 与内存存储的编译索引和分类结果一致；auto 模式在阈值附近冷启动与快照加载选择同一种存储"""
+    failures = []
+    with storage_mode("memory"):
+        memory_kb, _ = load_fresh(processor, folder_path)
+        wait_for_snapshot_writers()
+    with storage_mode("mmap"):
+        mapped_kb, _ = load_fresh(processor, folder_path)
+    if not isinstance(mapped_kb, MappedTagKnowledgeBase):
+        return ["mmap 模式没有映射快照"]
+
+    failures += [f"mmap: {failure}" for failure in compare_knowledge_bases(memory_kb, mapped_kb)]
+    prompts = generate_prompts(memory_kb, prompt_count)
+    memory_index = processor.get_compiled_tag_index(memory_kb)
+    mapped_index = processor.get_compiled_tag_index(mapped_kb)
+    sample_tags = {tag.strip().lower() for prompt in prompts for tag in prompt.split(',')}
+    mismatched = [tag for tag in sample_tags if memory_index.get(tag) != mapped_index.get(tag)]
+    if mismatched:
+        failures.append(f"编译索引不一致: {len(mismatched)} 个标签，例如 {mismatched[:5]}")
+    failures += compare_classification(processor, memory_kb, mapped_kb, prompts)
+
+    # 阈值恰好等于不重复标签数时两条路径都应使用 mmap，加一时都应使用内存存储
+    unique_count = len(frozenset().union(*memory_kb.values()))
+    snapshot_path = os.path.join(folder_path, TagKnowledgeSnapshot.FILENAME)
+    previous_threshold = AdvancedPromptProcessor.KNOWLEDGE_MMAP_THRESHOLD
+    try:
+        with storage_mode("auto"):
+            for threshold in (unique_count, unique_count + 1):
+                AdvancedPromptProcessor.KNOWLEDGE_MMAP_THRESHOLD = threshold
+                os.remove(snapshot_path)
+                cold_kb, _ = load_fresh(processor, folder_path)
+                wait_for_snapshot_writers()
+                warm_kb, _ = load_fresh(processor, folder_path)
+                if type(cold_kb) is not type(warm_kb):
+                    failures.append(f"阈值 {threshold}（不重复标签 {unique_count}）: 冷启动使用 "
+                                    f"{type(cold_kb).__name__}，快照加载使用 {type(warm_kb).__name__}")
+    finally:
+        AdvancedPromptProcessor.KNOWLEDGE_MMAP_THRESHOLD = previous_threshold
+    return failures
+
+
+def check_single_flight(processor, folder_path, prompt_count):
+    """多个线程同时首次加载只执行一次加载；命中缓存时不计算文件指纹；reload_knowledge_base 在后台更新"""
+    failures = []
+    cls = AdvancedPromptProcessor
+    calls = {"loads": 0, "fingerprints": 0}
+    original_load = cls._load_knowledge_base_internal
+    original_fingerprint = cls._knowledge_fingerprint.__func__
+
+    def counting_load(self, path):
+        calls["loads"] += 1
+        time.sleep(0.2)
+        return original_load(self, path)
+
+    def counting_fingerprint(klass, path):
+        calls["fingerprints"] += 1
+        return original_fingerprint(klass, path)
+
+    cls._load_knowledge_base_internal = counting_load
+    cls._knowledge_fingerprint = classmethod(counting_fingerprint)
+    try:
+        barrier = threading.Barrier(8)
+        results = [None] * 8
+
+        def first_caller(index):
+            barrier.wait()
+            results[index] = processor.load_knowledge_base_from_folder(folder_path)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            threads = [threading.Thread(target=first_caller, args=(index,)) for index in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if calls["loads"] != 1:
+            failures.append(f"8个线程同时首次加载执行了 {calls['loads']} 次加载（应为1次）")
+        if any(result is not results[0] for result in results) or not results[0]:
+            failures.append("同时首次加载的线程得到了不同的知识库")
+
+        fingerprints_before = calls["fingerprints"]
+        start = time.perf_counter()
+        for _ in range(10000):
+            processor.load_knowledge_base_from_folder(folder_path)
+        elapsed = time.perf_counter() - start
+        print(f"   缓存命中: {elapsed / 10000 * 1e6:.2f}µs/次")
+        if calls["fingerprints"] != fingerprints_before:
+            failures.append(f"缓存命中时计算了 {calls['fingerprints'] - fingerprints_before} 次文件指纹")
+
+        # 修改类别文件后 reload_knowledge_base 先返回旧版本，后台发布新版本
+        with open(os.path.join(folder_path, "characters.csv"), 'a', encoding='utf-8') as f:
+            f.write("\nzz_single_flight_check_character\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            if processor.reload_knowledge_base(folder_path) is not results[0]:
+                failures.append("reload_knowledge_base 没有在后台重新加载时返回旧版本")
+            deadline = time.monotonic() + 10
+            while processor.load_knowledge_base_from_folder(folder_path) is results[0] and time.monotonic() < deadline:
+                time.sleep(0.05)
+        if "zz_single_flight_check_character" not in processor.load_knowledge_base_from_folder(folder_path)["characters"]:
+            failures.append("reload_knowledge_base 没有发布修改后的知识库")
+    finally:
+        cls._load_knowledge_base_internal = original_load
+        cls._knowledge_fingerprint = classmethod(original_fingerprint)
+    return failures
+
+
+def main():
+    prompt_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    AdvancedPromptProcessor.KNOWLEDGE_HOT_RELOAD = False
+    processor = AdvancedPromptProcessor()
+    checks = [
+        ("快照与CSV一致", check_snapshot_parity),
+        ("mmap与内存存储一致", check_storage_parity),
+        ("单次加载与缓存命中", check_single_flight),
+    ]
+    failed = False
+    for name, check in checks:
+        with tempfile.TemporaryDirectory() as folder_path:
+            copy_knowledge_folder(folder_path)
+            print(f"🔍 {name}")
+            failures = check(processor, folder_path, prompt_count)
+            AdvancedPromptProcessor._KNOWLEDGE_CACHE.clear()
+        if failures:
+            failed = True
+            for failure in failures:
+                print(f"❌ {name}: {failure}")
+        else:
+            print(f"✅ {name}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())